@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark for log_analyzer on synthetic nginx logs
+run:
+python benchmark.py --lines 1000000 --urls 10000 --gzip -o bench.json
+"""
+import os
+import gzip
+import json
+import time
+import random
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+
+import log_analyzer
+
+
+USER_AGENTS = ('Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+               'Python-urllib/2.7', 'Slotovod', 'Configovod', '-',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)')
+URL_PATTERNS = ('/api/v2/banner/{}', '/api/v2/group/{}/banners', '/api/v2/slot/{}/groups',
+                '/api/v2/internal/banner/{}/info', '/api/1/photogenic_banners/list/?server_name={}',
+                '/api/v2/group/{}/statistic/sites/?date_type=day')
+
+
+def make_urls(urls, rnd):
+    """
+    Create list of distinct urls
+    """
+    result = []
+    seen = set()
+    while len(result) < urls:
+        url = rnd.choice(URL_PATTERNS).format(rnd.randint(1, 10**8))
+        if url not in seen:
+            seen.add(url)
+            result.append(url)
+    return result
+
+def generate_log(log_path, lines, urls, skew=1.0, seed=42):
+    """
+    Write reproducible synthetic log in LINEFORMAT_NAMED format.
+    Url popularity follows Zipf law with exponent skew, request time depends on url.
+    Log is gzipped if log_path ends with .gz
+    """
+    rnd = random.Random(seed)
+    url_list = make_urls(urls, rnd)
+    cum_weights = []
+    acc = 0
+    for rank in range(1, urls+1):
+        acc += 1/rank**skew
+        cum_weights.append(acc)
+    url_time = [rnd.uniform(0.01, 1.0) for _ in url_list]
+    start = datetime.datetime(2017, 6, 29, 3, 50, 22)
+    opener = gzip.open if log_path.endswith('.gz') else open
+    with opener(log_path, 'wt', encoding='utf-8') as log:
+        batch = []
+        for num in range(lines):
+            code = rnd.choices(range(urls), cum_weights=cum_weights)[0]
+            moment = start + datetime.timedelta(seconds=num//100)
+            batch.append(f'1.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)} '
+                         f'{rnd.choice(("-", "3b81f63526fa8"))}  - '
+                         f'[{moment.strftime("%d/%b/%Y:%H:%M:%S")} +0300] '
+                         f'"GET {url_list[code]} HTTP/1.1" 200 {rnd.randint(10, 30000)} "-" '
+                         f'"{rnd.choice(USER_AGENTS)}" "-" "1498697422-{rnd.randint(0, 10**9)}'
+                         f'-4708-{num}" "-" {rnd.expovariate(1/url_time[code]):.3f}\n')
+            if len(batch) == 10000:
+                log.writelines(batch)
+                batch = []
+        log.writelines(batch)
+
+def measure(results, stage, lines, func, *args):
+    """
+    Run func, record its wall time, lines/sec and change of resident memory into results.
+    Process peak RSS is kept by earlier stages, so memory of stage is measured as RSS delta
+    """
+    rss = log_analyzer.current_rss()
+    start_time = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start_time
+    rss = log_analyzer.current_rss() - rss if rss is not None else None
+    results[stage] = {'time': round(elapsed, 4),
+                      'lines_per_sec': round(lines/elapsed) if elapsed else None,
+                      'rss_delta_mb': round(rss, 1) if rss is not None else None}
+    return result
+
+def run_benchmark(conf, log_dir, log_name, lines):
+    """
+    Time xreadlines, process_logfile, calc_stat_top_urls and make_report separately
+    """
+    results = {}
+    log_path = os.path.join(log_dir, log_name)
+    measure(results, 'xreadlines', lines,
+            lambda: sum(1 for _ in log_analyzer.xreadlines(log_path)))
+    latest_log = log_analyzer.get_latest_log(log_dir)
+    dct_stat, processed, total_time, _ = measure(results, 'process_logfile', lines,
+                                                 log_analyzer.process_logfile, conf, latest_log)
+    top_urls = measure(results, 'calc_stat_top_urls', lines,
+                       log_analyzer.calc_stat_top_urls, conf, dct_stat, processed, total_time)
+    report_name = os.path.join(conf['REPORT_DIR'], 'report-benchmark.html')
+    measure(results, 'make_report', lines,
+            log_analyzer.make_report, report_name, [dct_stat[url] for url in top_urls])
+    return results
+
+def compare(results, baseline):
+    """
+    Print time change of each stage against baseline results
+    """
+    for stage, data in results['stages'].items():
+        if stage in baseline.get('stages', {}):
+            base_time = baseline['stages'][stage]['time']
+            change = (data['time'] - base_time)/base_time*100 if base_time else 0
+            print(f'{stage:20} {base_time:10.4f} -> {data["time"]:10.4f} s ({change:+.1f}%)')
+
+def main(args):
+    """
+    Main function
+    """
+    logging.basicConfig(level=logging.WARNING)
+    conf = log_analyzer.CONFIG.copy()
+    conf.update(option.split('=', 1) for option in args.option)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conf['LOG_DIR'] = conf['REPORT_DIR'] = tmp_dir
+        log_name = 'nginx-access-ui.log-20170630' + ('.gz' if args.gzip else '')
+        start_time = time.perf_counter()
+        generate_log(os.path.join(tmp_dir, log_name), args.lines, args.urls, args.skew, args.seed)
+        generate_time = time.perf_counter() - start_time
+        stages = run_benchmark(conf, tmp_dir, log_name, args.lines)
+        size = os.path.getsize(os.path.join(tmp_dir, log_name))
+    results = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'params': {'lines': args.lines, 'urls': args.urls, 'skew': args.skew,
+                          'gzip': args.gzip, 'seed': args.seed, 'log_size': size,
+                          'options': dict(option.split('=', 1) for option in args.option)},
+               'generate_time': round(generate_time, 4),
+               'stages': stages}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fout:
+            json.dump(results, fout, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as fbase:
+            compare(results, json.load(fbase))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('-n', '--lines', type=int, default=100000,
+                        help='Number of lines in synthetic log')
+    parser.add_argument('-u', '--urls', type=int, default=1000,
+                        help='Number of distinct urls')
+    parser.add_argument('-s', '--skew', type=float, default=1.0,
+                        help='Zipf exponent of url popularity, 0 is uniform')
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help='Gzip synthetic log')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed')
+    parser.add_argument('-O', '--option', action='append', default=[],
+                        help='log_analyzer config option KEY=VALUE, can be repeated')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Save results to json file')
+    parser.add_argument('-b', '--baseline', type=str, default=None,
+                        help='Compare with results saved by previous run')
+    main(parser.parse_args())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Queries to history database filled by log_analyzer with HISTORY_DB
+run:
+python history.py -d history.db series "/api/v2/banner/25019354 HTTP/1.1" --field time_med
+python history.py -d history.db top -n 10 --date-from 2017.06.01 --date-to 2017.06.30
+"""
+import sys
+import time
+import argparse
+
+import log_analyzer
+
+
+# Aggregates of top query over date range
+TOP_ORDER = ('count', 'time_sum', 'time_max', 'time_avg')
+
+
+def query_series(connection, url, field, date_from='', date_to=''):
+    """
+    Return list of (date, value) of report field of url in date order
+    """
+    if field not in log_analyzer.HISTORY_FIELDS:
+        raise ValueError(f'Unknown field {field}')
+    return connection.execute(f'SELECT date, {field} FROM url_stat '
+                              f'WHERE url = ? AND date >= ? AND date <= ? ORDER BY date',
+                              (url, date_from, date_to or '9999')).fetchall()
+
+def query_top(connection, size, order='time_sum', date_from='', date_to=''):
+    """
+    Return list of (url, count, time_sum, time_max, time_avg, days) of top urls
+    by aggregate over dates in range
+    """
+    if order not in TOP_ORDER:
+        raise ValueError(f'Unknown order {order}')
+    return connection.execute(f'SELECT url, SUM(count) AS count, '
+                              f'ROUND(SUM(time_sum), 3) AS time_sum, MAX(time_max) AS time_max, '
+                              f'ROUND(SUM(time_sum)/SUM(count), 3) AS time_avg, COUNT(*) AS days '
+                              f'FROM url_stat WHERE date >= ? AND date <= ? '
+                              f'GROUP BY url ORDER BY {order} DESC LIMIT ?',
+                              (date_from, date_to or '9999', size)).fetchall()
+
+def main(args):
+    """
+    Main function
+    """
+    connection = log_analyzer.open_history(args.db)
+    start_time = time.perf_counter()
+    if args.command == 'series':
+        rows = query_series(connection, args.url, args.field, args.date_from, args.date_to)
+    else:
+        print('url\tcount\ttime_sum\ttime_max\ttime_avg\tdays')
+        rows = query_top(connection, args.size, args.order, args.date_from, args.date_to)
+    for row in rows:
+        print('\t'.join(str(value) for value in row))
+    connection.close()
+    print(f'{len(rows)} rows in {(time.perf_counter() - start_time)*1000:.1f} ms', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='history.py')
+    parser.add_argument('-d', '--db', type=str, default='./history.db',
+                        help='Path to history database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    series = subparsers.add_parser('series', help='Daily values of url')
+    series.add_argument('url', type=str,
+                        help='Url as in report, e.g. "/api/v2/banner/25019354 HTTP/1.1"')
+    series.add_argument('-f', '--field', type=str, default='time_med',
+                        choices=log_analyzer.HISTORY_FIELDS,
+                        help='Report field')
+    top = subparsers.add_parser('top', help='Top urls over date range')
+    top.add_argument('-n', '--size', type=int, default=10,
+                     help='Number of urls')
+    top.add_argument('-o', '--order', type=str, default='time_sum', choices=TOP_ORDER,
+                     help='Aggregate to sort urls by')
+    for subparser in (series, top):
+        subparser.add_argument('--date-from', type=str, default='',
+                               help='First date YYYY.MM.DD')
+        subparser.add_argument('--date-to', type=str, default='',
+                               help='Last date YYYY.MM.DD')
+    main(parser.parse_args())
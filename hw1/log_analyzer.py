@@ -9,14 +9,48 @@ import os
 import sys
 import re
 import gzip
+import zlib
+import queue
+import threading
+import mmap
+import ctypes
+import ctypes.util
 from collections import namedtuple
 import datetime
 from string import Template
 import time
 import logging
 import json
+import math
+import random
+import hashlib
+import pickle
+import struct
+import sqlite3
+import tempfile
+import shutil
+import heapq
 from shutil import copyfile
 import argparse
+import signal
+import cProfile
+from functools import lru_cache
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    libz = ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+except OSError:
+    libz = None
 
 
 LINEFORMAT_NAMED = re.compile(r'(?P<remote_addr>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}) '+
@@ -28,15 +62,143 @@ LINEFORMAT_NAMED = re.compile(r'(?P<remote_addr>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,
                               r'" "(?P<http_x_forwarded_for>.*?)" "'+
                               r'(?P<http_X_REQUEST_ID>.*?)" "(?P<http_X_RB_USER>.*?)"'+
                               r' (?P<request_time>\d{0,}\.\d{1,}|\d{1,}\.\d{0,}|d{1,})')
+# The same format for lines read in bytes mode
+LINEFORMAT_NAMED_BYTES = re.compile(LINEFORMAT_NAMED.pattern.encode('utf-8'))
 
 CONFIG = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
     "LOG_DIR": "./log",
     "FORCE": False,
-    "SELF_LOG_DIR": "./"
+    "SELF_LOG_DIR": "./",
+    "WORKERS": 1,
+    "AGGREGATION": "exact",
+    "SKETCH_ACCURACY": 0.01,
+    "PARSER": "fast",
+    "FIELDS": "request,request_time",
+    "INCREMENTAL": False,
+    "BATCH_DAYS": 0,
+    "DATE_FROM": "",
+    "DATE_TO": "",
+    "GZIP_PIPELINE": False,
+    "COMPARE_READERS": False,
+    "NORMALIZE_URLS": False,
+    "URL_RULES": "",
+    "KEEP_QUERY_PARAMS": "",
+    "HEAVY_HITTERS": 0,
+    "BACKEND": "python",
+    "PERCENTILES": "",
+    "METRICS_FILE": "",
+    "PROFILE": False,
+    "CACHE_DIR": "",
+    "CACHE_SIZE_MB": 1024,
+    "DAEMON": False,
+    "POLL_INTERVAL": 10,
+    "GROUP_BY": "url",
+    "READ_MODE": "text",
+    "MMAP": False,
+    "GZIP_INDEX": False,
+    "GZIP_INDEX_SPAN_MB": 4,
+    "SAMPLE": 0,
+    "HISTORY_DB": "",
+    "SPILL_ENTRIES": 0,
+    "SPILL_RSS_MB": 0,
+    "SPILL_PARTITIONS": 16,
+    "SPILL_DIR": ""
 }
 
+LOG_NAME_REGEX = re.compile(r'^nginx-access-ui\.log-(\d{8})(\.gz)?$')
+LogFile = namedtuple('LogFile', 'name date ext')
+
+# Fields of LINEFORMAT_NAMED in the order of appearance in log line
+LINE_FIELDS = ('remote_addr', 'remote_user', 'http_x_real_ip', 'time_local', 'request',
+               'status', 'body_bytes_sent', 'http_referer', 'http_user_agent',
+               'http_x_forwarded_for', 'http_X_REQUEST_ID', 'http_X_RB_USER', 'request_time')
+# Fields required for aggregation by url
+REQUIRED_FIELDS = ('request', 'request_time')
+# Options which change partial aggregates,
+# checkpoint and cached aggregates are dropped if any of them (or URL_RULES file) changes
+AGGREGATE_OPTIONS = ('AGGREGATION', 'SKETCH_ACCURACY', 'NORMALIZE_URLS', 'URL_RULES',
+                     'KEEP_QUERY_PARAMS', 'HEAVY_HITTERS', 'BACKEND', 'GROUP_BY', 'PARSER',
+                     'READ_MODE', 'FIELDS')
+# Number of first bytes of log file used as its fingerprint
+CHECKPOINT_HEAD_SIZE = 4096
+
+# Default rules (regex, replacement) for url path normalization
+DEFAULT_URL_RULES = (
+    (r'/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)',
+     '/{uuid}'),
+    (r'/\d+(?=/|$)', '/{id}'),
+    (r'/(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{16,}(?=/|$)', '/{hash}'),
+)
+# Maximum number of raw urls memorized by url normalizer and bytes mode parser
+URL_CACHE_SIZE = 100000
+
+# Number of byte ranges per worker, several ranges let fast workers pick up extra work
+CHUNKS_PER_WORKER = 4
+# Size of compressed blocks inflated at once by pipelined gzip reader
+GZIP_BLOCK_SIZE = 64*1024
+# Maximum number of inflated blocks waiting for parsing
+GZIP_QUEUE_SIZE = 8
+# Error of gzip log ended inside compressed stream, as gzip module reports it
+GZIP_TRUNCATED = 'Compressed file ended before the end-of-stream marker was reached'
+# Size of deflate window saved in each access point of gzip index
+GZIP_WINDOW_SIZE = 32768
+# Gzip index file: header (magic, log size, log mtime_ns, number of points), then points
+# (uncompressed offset, compressed offset, bits, window length) each followed by its window
+GZIP_INDEX_MAGIC = b'GZIX1'
+GZIP_INDEX_HEADER = struct.Struct('<5sQqI')
+GZIP_INDEX_POINT = struct.Struct('<QQBI')
+# Maximum size of uncompressed log blocks and number of lines of gzip log blocks in sample mode
+SAMPLE_BLOCK_SIZE = 256*1024
+SAMPLE_BLOCK_LINES = 1000
+# Minimum number of sampled blocks of uncompressed log
+SAMPLE_MIN_BLOCKS = 30
+# Normal quantile of 95% confidence intervals
+SAMPLE_Z = 1.96
+# Number of lines between checks of resident memory against SPILL_RSS_MB
+SPILL_CHECK_LINES = 10000
+# Number of daemon attempts to process a log before it's skipped
+DAEMON_ATTEMPTS = 3
+# Report row fields saved to history database
+HISTORY_FIELDS = ('count', 'count_perc', 'time_sum', 'time_perc', 'time_avg', 'time_max',
+                  'time_med')
+# Tables of history database, url_stat is clustered by (url, date) for time series of url,
+# url_stat_date index covers top urls for date range
+HISTORY_SCHEMA = '''
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS url_stat (
+    date TEXT NOT NULL,
+    url TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    count_perc REAL NOT NULL,
+    time_sum REAL NOT NULL,
+    time_perc REAL NOT NULL,
+    time_avg REAL NOT NULL,
+    time_max REAL NOT NULL,
+    time_med REAL NOT NULL,
+    PRIMARY KEY (url, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS url_stat_date ON url_stat (date, url, time_sum, count, time_max);
+CREATE TABLE IF NOT EXISTS runs (
+    date TEXT PRIMARY KEY,
+    processed INTEGER NOT NULL,
+    total_time REAL NOT NULL,
+    created TEXT NOT NULL
+);
+'''
+# zlib constants not exported by zlib module
+Z_OK, Z_STREAM_END, Z_NEED_DICT, Z_BUF_ERROR = 0, 1, 2, -5
+Z_NO_FLUSH, Z_BLOCK = 0, 5
+# Number of lines read, parsed and aggregated at once, stages are measured per block
+TIMED_BLOCK_SIZE = 10000
+# Stages of parse_lines, not measured when it runs in worker processes
+LINE_STAGES = ('read', 'parse', 'aggregate')
+# Buffer size of log file opened in bytes mode
+BINARY_BUFFER_SIZE = 1024*1024
+# Size of memory mapped log blocks split into lines at once, pages of split blocks are released
+MMAP_BLOCK_SIZE = 1024*1024
+
 
 def median(nums: list):
     """
@@ -47,6 +209,514 @@ def median(nums: list):
         return nums[list_length//2]
     return sum(nums[list_length//2-1:list_length//2+1])/2
 
+class QuantileSketch():
+    """
+    Mergeable streaming quantile sketch with relative accuracy bound.
+    Values are counted in logarithmic buckets, so estimated quantile
+    differs from the true one by no more than accuracy*value.
+    Memory depends on the range of values, not on their number.
+    """
+    MIN_VALUE = 1e-9
+
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1+accuracy)/(1-accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        """
+        Add value to sketch
+        """
+        self.count += 1
+        if value < self.MIN_VALUE:
+            self.zeros += 1
+            return
+        key = math.ceil(math.log(value)/self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other):
+        """
+        Add all values of other sketch with the same accuracy
+        """
+        if other.accuracy != self.accuracy:
+            raise ValueError('Can not merge sketches with different accuracy')
+        self.count += other.count
+        self.zeros += other.zeros
+        for key, num in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + num
+        return self
+
+    def quantile(self, q):
+        """
+        Estimate q-quantile (0 <= q <= 1) of added values, interpolating between
+        the two nearest ranks as the exact median of even number of values does
+        """
+        if not self.count:
+            return None
+        rank = q*(self.count-1)
+        low = self.value_at(math.floor(rank))
+        high = self.value_at(math.ceil(rank))
+        return low + (rank - math.floor(rank))*(high - low)
+
+    def value_at(self, rank):
+        """
+        Estimate value with 0-based rank in sorted added values
+        """
+        if rank < self.zeros:
+            return 0.0
+        cum = self.zeros
+        for key in sorted(self.buckets):
+            cum += self.buckets[key]
+            if cum > rank:
+                break
+        return 2*self.gamma**key/(self.gamma+1)
+
+    def to_dict(self):
+        """
+        Serialize sketch to json-compatible dictionary
+        """
+        return {'accuracy': self.accuracy, 'zeros': self.zeros, 'count': self.count,
+                'buckets': [[key, num] for key, num in self.buckets.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Restore sketch serialized by to_dict
+        """
+        sketch = cls(data['accuracy'])
+        sketch.zeros = data['zeros']
+        sketch.count = data['count']
+        sketch.buckets = {key: num for key, num in data['buckets']}
+        return sketch
+
+class UrlNormalizer():
+    """
+    Rewrite urls into templates: ids in path are replaced by compiled rules,
+    query string is dropped except listed parameters, protocol is kept.
+    Results are memorized for already seen raw urls
+    """
+    def __init__(self, rules=DEFAULT_URL_RULES, keep_params=(), cache_size=URL_CACHE_SIZE):
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.keep_params = set(keep_params)
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def normalize(self, request):
+        """
+        Normalize request string like "/api/v2/banner/25019354 HTTP/1.1"
+        """
+        url, _, protocol = request.rpartition(' ')
+        if not protocol.startswith('HTTP/'):
+            url, protocol = request, ''
+        path, _, query = url.partition('?')
+        for pattern, replacement in self.rules:
+            path = pattern.sub(replacement, path)
+        params = [param for param in query.split('&')
+                  if param and param.partition('=')[0] in self.keep_params]
+        if params:
+            path += '?' + '&'.join(params)
+        if protocol:
+            path += ' ' + protocol
+        return path
+
+    def __call__(self, request):
+        template = self.cache.get(request)
+        if template is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            template = self.cache[request] = self.normalize(request)
+        return template
+
+class HeavyHitters():
+    """
+    Weighted Space-Saving summary: keeps at most capacity urls with the largest
+    total request time. New url replaces the url with minimal weight and inherits
+    its weight as error, so true time_sum of url is in [weight-error, weight]
+    and error never exceeds total_time/capacity.
+    Each counter keeps count/sum/max and quantile sketch of given accuracy
+    (SKETCH_ACCURACY by default), so memory doesn't grow with requests of url
+    """
+    def __init__(self, capacity, accuracy=None):
+        self.capacity = capacity
+        self.accuracy = float(CONFIG['SKETCH_ACCURACY']) if accuracy is None else accuracy
+        self.stats = {}
+        # (weight, url) lower bounds of current weights, refreshed lazily on pop
+        self.heap = []
+
+    def pop_min(self):
+        """
+        Remove url with minimal weight and return its weight
+        """
+        while True:
+            weight, url = heapq.heappop(self.heap)
+            current = self.stats[url]['weight']
+            if current == weight:
+                del self.stats[url]
+                return weight
+            heapq.heappush(self.heap, (current, url))
+
+    def add(self, url, req_time):
+        """
+        Add request time of url
+        """
+        stat = self.stats.get(url)
+        if stat is None:
+            error = self.pop_min() if len(self.stats) >= self.capacity else 0.0
+            stat = self.stats[url] = new_stat(self.accuracy)
+            stat['weight'] = stat['error'] = error
+            heapq.heappush(self.heap, (error, url))
+        add_time(stat, req_time)
+        stat['weight'] += req_time
+
+def get_capacity(conf):
+    """
+    Return number of counters for heavy hitters mode or 0 if it's off
+    """
+    return int(get_option(conf, 'HEAVY_HITTERS'))
+
+def get_normalizer(conf):
+    """
+    Create url normalizer from config or return None if normalization is off.
+    URL_RULES is path to json file with list of [regex, replacement] pairs
+    """
+    if not get_flag(conf, 'NORMALIZE_URLS'):
+        return None
+    rules = DEFAULT_URL_RULES
+    if get_option(conf, 'URL_RULES'):
+        with open(get_option(conf, 'URL_RULES'), 'r', encoding='utf-8') as frules:
+            rules = json.load(frules)
+    keep_params = [param.strip() for param in get_option(conf, 'KEEP_QUERY_PARAMS').split(',')
+                   if param.strip()]
+    return UrlNormalizer(rules, keep_params)
+
+class Dimension():
+    """
+    Group-by key of single-pass aggregation: log field, optional function
+    making key from field value, and whether body bytes sent are summed
+    """
+    def __init__(self, field, key=None, bytes_sent=False):
+        self.field = field
+        self.key = key
+        self.bytes_sent = bytes_sent
+
+
+# Dimensions aggregated besides url, time_local looks like 29/Jun/2017:03:50:22 +0300
+DIMENSIONS = {
+    'status': Dimension('status', bytes_sent=True),
+    'hour': Dimension('time_local', key=lambda value: value[12:14]),
+    'remote_addr': Dimension('remote_addr', bytes_sent=True),
+}
+
+def register_dimension(name, field, key=None, bytes_sent=False):
+    """
+    Add dimension which can be used in GROUP_BY
+    """
+    if field not in LINE_FIELDS:
+        raise ValueError(f'Unknown log field {field}')
+    DIMENSIONS[name] = Dimension(field, key, bytes_sent)
+
+def get_dimensions(conf):
+    """
+    Return list of (name, dimension) aggregated besides url
+    """
+    dimensions = []
+    for name in get_option(conf, 'GROUP_BY').split(','):
+        name = name.strip()
+        if not name or name == 'url':
+            continue
+        if name not in DIMENSIONS:
+            raise ValueError(f'Unknown dimension {name}')
+        dimensions.append((name, DIMENSIONS[name]))
+    return dimensions
+
+def new_stat(accuracy=None):
+    """
+    Create empty per-url aggregate: list of all times for exact mode,
+    or count/sum/max with quantile sketch when accuracy is given
+    """
+    if accuracy is None:
+        return {'times': []}
+    return {'count': 0, 'time_sum': 0.0, 'time_max': 0.0, 'sketch': QuantileSketch(accuracy)}
+
+def get_option(conf, key):
+    """
+    Get config value or its default
+    """
+    return conf.get(key, CONFIG[key])
+
+def get_flag(conf, key):
+    """
+    Get boolean config value, config file gives strings like 1/true/yes
+    """
+    value = get_option(conf, key)
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def get_aggregate_options(conf):
+    """
+    Return AGGREGATE_OPTIONS values as strings, URL_RULES is given by hash of rules file
+    contents, so editing the file also drops checkpoint and cached aggregates
+    """
+    options = {key: str(get_option(conf, key)) for key in AGGREGATE_OPTIONS}
+    if options['URL_RULES']:
+        try:
+            with open(options['URL_RULES'], 'rb') as frules:
+                options['URL_RULES'] = hashlib.md5(frules.read()).hexdigest()
+        except OSError:
+            # missing rules file is reported by get_normalizer
+            pass
+    return options
+
+def get_fields(conf):
+    """
+    Return tuple of fields to extract from log line: required ones and those listed in FIELDS
+    """
+    fields = list(REQUIRED_FIELDS)
+    for _, dimension in get_dimensions(conf):
+        for field in (dimension.field, 'body_bytes_sent' if dimension.bytes_sent else None):
+            if field and field not in fields:
+                fields.append(field)
+    for field in get_option(conf, 'FIELDS').split(','):
+        field = field.strip()
+        if field and field not in fields:
+            if field not in LINE_FIELDS:
+                raise ValueError(f'Unknown log field {field}')
+            fields.append(field)
+    return tuple(fields)
+
+def get_accuracy(conf):
+    """
+    Return sketch accuracy for sketch aggregation mode or None for exact mode
+    """
+    if get_option(conf, 'AGGREGATION') == 'sketch':
+        return float(get_option(conf, 'SKETCH_ACCURACY'))
+    return None
+
+def percentile(nums: list, perc):
+    """
+    Calculate percentile of numbers in sorted list with linear interpolation
+    """
+    pos = (len(nums)-1)*perc/100
+    low = int(pos)
+    high = min(low+1, len(nums)-1)
+    return nums[low] + (nums[high]-nums[low])*(pos-low)
+
+def get_percentiles(conf):
+    """
+    Return list of extra percentiles to report for exact aggregation
+    """
+    return [float(perc) for perc in str(get_option(conf, 'PERCENTILES')).split(',')
+            if perc.strip()]
+
+def percentile_name(perc):
+    """
+    Return report column name for percentile
+    """
+    return f'time_p{perc:g}'
+
+class ColumnarStats():
+    """
+    Columnar aggregates for numpy backend: each url is interned to integer code,
+    codes and request times are appended to typed arrays.
+    Statistics are computed by vectorized group-by in calc_stat_top_urls,
+    then rows are available by url like in dictionary of per-url aggregates
+    """
+    def __init__(self):
+        self.codes = {}
+        self.urls = []
+        self.url_codes = array('I')
+        self.times = array('d')
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __getitem__(self, url):
+        return self.rows[url]
+
+    def add(self, url, req_time):
+        """
+        Add request time of url
+        """
+        code = self.codes.get(url)
+        if code is None:
+            code = self.codes[url] = len(self.urls)
+            self.urls.append(url)
+        self.url_codes.append(code)
+        self.times.append(req_time)
+
+    def merge(self, other):
+        """
+        Append aggregates of other columnar stats recoding its urls
+        """
+        recode = np.empty(len(other.urls), dtype='I')
+        for code, url in enumerate(other.urls):
+            new_code = self.codes.get(url)
+            if new_code is None:
+                new_code = self.codes[url] = len(self.urls)
+                self.urls.append(url)
+            recode[code] = new_code
+        self.url_codes.frombytes(recode[np.frombuffer(other.url_codes, dtype='I')].tobytes())
+        self.times.extend(other.times)
+        return self
+
+    def to_dict(self):
+        """
+        Serialize to json-compatible dictionary
+        """
+        return {'urls': self.urls, 'url_codes': self.url_codes.tolist(),
+                'times': self.times.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Restore columnar stats serialized by to_dict
+        """
+        columnar = cls()
+        columnar.urls = data['urls']
+        columnar.codes = {url: code for code, url in enumerate(columnar.urls)}
+        columnar.url_codes = array('I', data['url_codes'])
+        columnar.times = array('d', data['times'])
+        return columnar
+
+def get_backend(conf):
+    """
+    Return aggregation backend: numpy for exact aggregation if numpy is installed, else python
+    """
+    if (get_option(conf, 'BACKEND') == 'numpy' and np is not None
+            and get_accuracy(conf) is None and not get_capacity(conf)):
+        return 'numpy'
+    return 'python'
+
+def peak_rss():
+    """
+    Peak resident set size of current process and its finished children in MB
+    """
+    if resource is None:
+        return None
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes on Linux
+    return round(usage/1024/1024 if sys.platform == 'darwin' else usage/1024, 1)
+
+def current_rss():
+    """
+    Current resident set size of process in MB, peak one if current is not available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1])*mmap.PAGESIZE/1024/1024
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+def cpu_time():
+    """
+    CPU time of current process and its finished children (worker pools)
+    """
+    if resource is None:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+class StageMetrics():
+    """
+    Collect wall time, CPU time, lines/sec and change of resident memory of analyzer stages.
+    Time of nested stage is excluded from the enclosing one, memory change is not.
+    Stages which can't be measured in this run are recorded as unavailable with reason
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget collected stages
+        """
+        self.stages = {}
+        self.unavailable = {}
+        self.lines = 0
+        self.stack = []
+
+    def add(self, name, wall, cpu, rss_delta=0.0):
+        """
+        Add wall and cpu time and resident memory change in MB to stage
+        """
+        stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'rss_delta_mb': 0.0})
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['rss_delta_mb'] += rss_delta
+        if self.stack:
+            self.stack[-1][0] += wall
+            self.stack[-1][1] += cpu
+
+    def mark_unavailable(self, name, reason):
+        """
+        Record that stage is not measured in this run
+        """
+        self.unavailable[name] = reason
+
+    def mark_in_workers(self, reason):
+        """
+        Record that lines are read, parsed and aggregated in worker processes
+        """
+        for name in LINE_STAGES:
+            self.mark_unavailable(name, reason)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager measuring stage
+        """
+        nested = [0.0, 0.0]
+        self.stack.append(nested)
+        wall, cpu, rss = time.perf_counter(), cpu_time(), current_rss()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, cpu_time() - cpu
+            rss = current_rss() - rss if rss is not None else 0.0
+            self.stack.pop()
+            self.add(name, wall - nested[0], cpu - nested[1], rss)
+
+    def result(self):
+        """
+        Return stages with lines/sec calculated for number of log lines
+        """
+        result = {}
+        for name, stage in self.stages.items():
+            result[name] = {'wall': round(stage['wall'], 4), 'cpu': round(stage['cpu'], 4),
+                            'lines_per_sec': round(self.lines/stage['wall'])
+                                             if stage['wall'] > 0 else None,
+                            'rss_delta_mb': round(stage['rss_delta_mb'], 1)}
+        return result
+
+    def log(self):
+        """
+        Write stages to script log
+        """
+        for name, stage in self.result().items():
+            logging.info(msg=f"Stage {name}: wall {stage['wall']} s, cpu {stage['cpu']} s, "
+                             f"{stage['lines_per_sec']} lines/s, "
+                             f"RSS change {stage['rss_delta_mb']:+} MB")
+        for name, reason in self.unavailable.items():
+            if name not in self.stages:
+                logging.info(msg=f'Stage {name}: unavailable, {reason}')
+        logging.info(msg=f'Peak RSS {peak_rss()} MB')
+
+    def save(self, path):
+        """
+        Save stages to json file
+        """
+        unavailable = {name: reason for name, reason in self.unavailable.items()
+                       if name not in self.stages}
+        with open(path, 'w', encoding='utf-8') as fmetrics:
+            json.dump({'lines': self.lines, 'peak_rss_mb': peak_rss(), 'stages': self.result(),
+                       'unavailable': unavailable}, fmetrics, indent=2)
+
+
 def configure_logging(conf):
     """
     Configure logging using config path.
@@ -65,44 +735,94 @@ def configure_logging(conf):
     logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
     return 1
 
-def get_latest_log(log_dir):
+def find_logs(log_dir):
     """
-    Search for latest log file and return named tuple with name, date, ext
+    Search for all log files and return list of named tuples with name, date, ext
     """
-    regex = re.compile(r'^nginx-access-ui\.log-(\d{8})(\.gz)?$')
-    LogFile = namedtuple('LogFile', 'name date ext')
-    maxdate = 0
-    max_filename = ''
-    max_file_ext = ''
+    logs = []
     for filename in os.listdir(log_dir):
-        res = regex.findall(filename)
+        res = LOG_NAME_REGEX.findall(filename)
         if res:
             res = res[0]
-            curdate = int(res[0])
-            if maxdate < curdate:
-                maxdate = curdate
-                max_filename = filename
-                max_file_ext = res[1]
-    if maxdate == 0:
+            date = datetime.datetime.strptime(res[0], '%Y%m%d').date()
+            logs.append(LogFile(name=filename,
+                                date=datetime.datetime.strftime(date, '%Y.%m.%d'),
+                                ext=res[1]))
+    return logs
+
+def get_latest_log(log_dir):
+    """
+    Search for latest log file and return named tuple with name, date, ext
+    """
+    logs = find_logs(log_dir)
+    if not logs:
         return None
-    date = datetime.datetime.strptime(str(maxdate), '%Y%m%d').date()
-    return LogFile(name=max_filename,
-                   date=datetime.datetime.strftime(date, '%Y.%m.%d'),
-                   ext=max_file_ext)
+    return max(logs, key=lambda log: log.date)
+
+def get_batch_logs(conf):
+    """
+    Return logs for batch mode sorted by date: logs of last BATCH_DAYS days up to the latest log,
+    or logs with dates between DATE_FROM and DATE_TO (YYYY.MM.DD, both inclusive)
+    """
+    for key in ('DATE_FROM', 'DATE_TO'):
+        if get_option(conf, key):
+            try:
+                datetime.datetime.strptime(get_option(conf, key), '%Y.%m.%d')
+            except ValueError:
+                raise ValueError(f'{key} must be a date YYYY.MM.DD, got {get_option(conf, key)}')
+    logs = {}
+    for log in find_logs(conf['LOG_DIR']):
+        # the first found file of the date is taken like in get_latest_log
+        logs.setdefault(log.date, log)
+    if not logs:
+        return []
+    days = int(get_option(conf, 'BATCH_DAYS'))
+    if days:
+        date_to = datetime.datetime.strptime(max(logs), '%Y.%m.%d')
+        date_from = (date_to - datetime.timedelta(days=days-1)).strftime('%Y.%m.%d')
+        date_to = date_to.strftime('%Y.%m.%d')
+    else:
+        date_from = get_option(conf, 'DATE_FROM') or min(logs)
+        date_to = get_option(conf, 'DATE_TO') or max(logs)
+    return [logs[date] for date in sorted(logs) if date_from <= date <= date_to]
+
+def is_batch(conf):
+    """
+    Check if batch mode for several logs is configured
+    """
+    return bool(int(get_option(conf, 'BATCH_DAYS')) or get_option(conf, 'DATE_FROM')
+                or get_option(conf, 'DATE_TO'))
 
-def make_report(report_name, dict_list):
+@lru_cache(maxsize=None)
+def load_template(template_name):
     """
-    Create report from template and given data.
+    Read report template once per process
     """
-    with open('report.html', 'r', encoding='utf-8') as frep_tmpl:
-        report_template = Template(frep_tmpl.read())
+    with open(template_name, 'r', encoding='utf-8') as frep_tmpl:
+        return Template(frep_tmpl.read())
+
+def make_report(report_name, dict_list, key='url'):
+    """
+    Create report from template and given data, column key is shown first.
+    """
+    report_template = load_template('report.html')
     with open(report_name, 'w', encoding='utf-8') as freport:
-        freport.write(report_template.safe_substitute({'table_json': json.dumps(dict_list)}))
+        freport.write(report_template.safe_substitute({'table_json': json.dumps(dict_list),
+                                                       'key_column': key}))
 
-def xreadlines(log_path):
+def xreadlines(log_path, binary=False):
     """
-    Generator for reading file line by line
+    Generator for reading file line by line, lines are not decoded if binary
     """
+    if binary:
+        raw = open(log_path, 'rb', buffering=BINARY_BUFFER_SIZE)
+        log = gzip.GzipFile(fileobj=raw) if log_path.endswith(".gz") else raw
+        try:
+            yield from log
+        finally:
+            log.close()
+            raw.close()
+        return
     if log_path.endswith(".gz"):
         log = gzip.open(log_path, 'rt', encoding="utf-8")
     else:
@@ -111,62 +831,1646 @@ def xreadlines(log_path):
         yield line
     log.close()
 
-def process_logfile(conf, latest_log):
+def advise(mapping, name, start=0, length=0):
     """
-    Read log file and parse line by line.
-    Return dictionary with each row, number of processed rows, and total_time taken by requests
+    Give memory usage advice for memory mapped file if platform supports it
     """
-    logging.info(msg=f'Starting log_analyzer with config {str(conf)}')
-    logging.info(msg=f'Latest log date is {latest_log.date}')
-    log_lines = xreadlines(conf['LOG_DIR']+'/'+latest_log.name)
+    advice = getattr(mmap, name, None)
+    if advice is not None and hasattr(mapping, 'madvise'):
+        mapping.madvise(advice, start, length)
+
+def xreadlines_mmap(log_path, start=0, end=None):
+    """
+    Generator for reading lines of uncompressed file (or lines starting in byte range
+    [start, end)) as bytes without trailing newline from memory map. Line-aligned block ends
+    are found in the mapping, so there are no read buffers, and pages of processed blocks
+    are released, so resident memory doesn't grow with file size
+    """
+    with open(log_path, 'rb') as log:
+        size = os.fstat(log.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            advise(mapping, 'MADV_SEQUENTIAL')
+            released = start - start % mmap.PAGESIZE
+            pos = start
+            while pos < end:
+                newline = mapping.find(b'\n', min(pos + MMAP_BLOCK_SIZE, end) - 1)
+                block_end = size if newline == -1 else newline + 1
+                lines = mapping[pos:block_end].split(b'\n')
+                if newline != -1:
+                    lines.pop()
+                yield from lines
+                pos = block_end
+                page_end = pos - pos % mmap.PAGESIZE
+                if page_end > released:
+                    advise(mapping, 'MADV_DONTNEED', released, page_end - released)
+                    released = page_end
+
+def inflate_members(log, data=b'', block_size=GZIP_BLOCK_SIZE):
+    """
+    Generator inflating gzip members from data and the rest of opened file
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    started = False
+    while True:
+        if not data:
+            data = log.read(block_size)
+            if not data:
+                break
+        started = True
+        chunk = decompressor.decompress(data)
+        if chunk:
+            yield chunk
+        if decompressor.eof:
+            # next member of multi-member gzip file
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            started = False
+        else:
+            data = b''
+    if started:
+        raise EOFError(GZIP_TRUNCATED)
+
+def inflate_gzip(log_path, blocks, stop, block_size=GZIP_BLOCK_SIZE):
+    """
+    Producer stage of pipelined gzip reader: inflate large compressed blocks
+    (zlib releases the GIL meanwhile) and put byte chunks to the bounded queue.
+    None is put at the end, exception is passed to consumer
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        with open(log_path, 'rb') as log:
+            for chunk in inflate_members(log, block_size=block_size):
+                if stop.is_set():
+                    break
+                put(chunk)
+    except Exception as error:
+        put(error)
+    finally:
+        put(None)
+
+def xreadlines_pipelined(log_path, binary=False):
+    """
+    Generator for reading gzip file line by line: inflating runs in separate thread,
+    decoding and splitting lines are done by large chunks in the current one.
+    Lines are yielded without trailing newline, not decoded if binary
+    """
+    blocks = queue.Queue(maxsize=GZIP_QUEUE_SIZE)
+    stop = threading.Event()
+    producer = threading.Thread(target=inflate_gzip, args=(log_path, blocks, stop), daemon=True)
+    producer.start()
+    tail = b''
+    try:
+        while True:
+            chunk = blocks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            data = tail + chunk
+            cut = data.rfind(b'\n') + 1
+            tail = data[cut:]
+            if cut and binary:
+                lines = data[:cut].split(b'\n')
+                lines.pop()
+                yield from lines
+            elif cut:
+                lines = data[:cut].decode('utf-8').split('\n')
+                lines.pop()
+                yield from lines
+        if tail:
+            yield tail if binary else tail.decode('utf-8')
+    finally:
+        stop.set()
+        producer.join()
+
+class ZStream(ctypes.Structure):
+    """
+    z_stream structure of libz
+    """
+    _fields_ = [('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong), ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint), ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p), ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong), ('reserved', ctypes.c_ulong)]
+
+if libz is not None:
+    libz.zlibVersion.restype = ctypes.c_char_p
+    libz.inflateInit2_.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_int]
+    libz.inflate.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int]
+    libz.inflateEnd.argtypes = [ctypes.POINTER(ZStream)]
+    libz.inflateReset.argtypes = [ctypes.POINTER(ZStream)]
+    libz.inflatePrime.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_int]
+    libz.inflateSetDictionary.argtypes = [ctypes.POINTER(ZStream), ctypes.c_char_p,
+                                          ctypes.c_uint]
+
+class Inflater():
+    """
+    Decompressor calling libz directly. Unlike zlib module it can stop at deflate
+    block boundaries (Z_BLOCK) and start in the middle of raw deflate stream
+    (inflatePrime, inflateSetDictionary), which is needed for gzip access points
+    """
+    def __init__(self, wbits, out_size=GZIP_BLOCK_SIZE):
+        self.stream = ZStream()
+        self.input = None
+        self.output = ctypes.create_string_buffer(out_size)
+        self.check(libz.inflateInit2_(ctypes.byref(self.stream), wbits, libz.zlibVersion(),
+                                      ctypes.sizeof(ZStream)))
+
+    def check(self, ret, allowed=(Z_OK,)):
+        """
+        Raise zlib.error if libz returned error code
+        """
+        if ret not in allowed:
+            message = self.stream.msg.decode('utf-8', 'replace') if self.stream.msg else ret
+            raise zlib.error(f'Error {message} while decompressing data')
+        return ret
+
+    def prime(self, bits, value):
+        """
+        Insert bits of byte preceding access point into input stream
+        """
+        self.check(libz.inflatePrime(ctypes.byref(self.stream), bits, value))
+
+    def set_dictionary(self, window):
+        """
+        Set uncompressed data preceding access point as deflate window
+        """
+        if window:
+            self.check(libz.inflateSetDictionary(ctypes.byref(self.stream), window, len(window)))
+
+    def feed(self, data):
+        """
+        Set next input bytes, previous input must be consumed
+        """
+        self.input = ctypes.create_string_buffer(data, len(data))
+        self.stream.next_in = ctypes.addressof(self.input)
+        self.stream.avail_in = len(data)
+
+    def unused_data(self):
+        """
+        Return input bytes not consumed by decompressor
+        """
+        if not self.stream.avail_in:
+            return b''
+        return ctypes.string_at(self.stream.next_in, self.stream.avail_in)
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        """
+        Inflate pending input into output buffer.
+        Return (libz code, number of consumed input bytes, output bytes)
+        """
+        avail_in = self.stream.avail_in
+        self.stream.next_out = ctypes.addressof(self.output)
+        self.stream.avail_out = len(self.output)
+        ret = self.check(libz.inflate(ctypes.byref(self.stream), flush),
+                         (Z_OK, Z_STREAM_END, Z_BUF_ERROR))
+        return (ret, avail_in - self.stream.avail_in,
+                self.output.raw[:len(self.output) - self.stream.avail_out])
+
+    def reset(self):
+        """
+        Prepare for the next gzip member keeping unused input
+        """
+        self.check(libz.inflateReset(ctypes.byref(self.stream)))
+
+    def close(self):
+        """
+        Free libz state
+        """
+        libz.inflateEnd(ctypes.byref(self.stream))
+
+def inflate_indexing(log_path, points, span):
+    """
+    Generator inflating whole gzip file and adding access points to list points
+    about every span bytes of uncompressed data (zran approach).
+    Point is tuple (uncompressed offset, compressed offset, number of bits of
+    the previous byte belonging to the point, zlib compressed 32 KB window before the point)
+    """
+    inflater = Inflater(zlib.MAX_WBITS | 32)
+    window = b''
+    total_in = total_out = 0
+    last = -span
+    started = False
+    try:
+        with open(log_path, 'rb') as log:
+            while True:
+                if not inflater.stream.avail_in:
+                    data = log.read(GZIP_BLOCK_SIZE)
+                    if not data:
+                        if started:
+                            raise EOFError(GZIP_TRUNCATED)
+                        break
+                    inflater.feed(data)
+                    started = True
+                ret, used, chunk = inflater.inflate(Z_BLOCK)
+                total_in += used
+                if chunk:
+                    total_out += len(chunk)
+                    window = (window + chunk)[-GZIP_WINDOW_SIZE:]
+                    yield chunk
+                if ret == Z_STREAM_END:
+                    # next member of multi-member gzip file
+                    inflater.reset()
+                    started = inflater.stream.avail_in > 0
+                    continue
+                data_type = inflater.stream.data_type
+                # end of deflate block header which is not the last one
+                if data_type & 128 and not data_type & 64 and total_out - last >= span:
+                    points.append((total_out, total_in, data_type & 7, zlib.compress(window)))
+                    last = total_out
+    finally:
+        inflater.close()
+
+def inflate_from_point(log_path, point):
+    """
+    Generator inflating gzip file from access point to the end
+    """
+    _, offset, bits, window = point
+    inflater = Inflater(-zlib.MAX_WBITS)
+    try:
+        with open(log_path, 'rb') as log:
+            log.seek(offset - (1 if bits else 0))
+            if bits:
+                inflater.prime(bits, log.read(1)[0] >> (8 - bits))
+            inflater.set_dictionary(zlib.decompress(window))
+            while True:
+                if not inflater.stream.avail_in:
+                    data = log.read(GZIP_BLOCK_SIZE)
+                    if not data:
+                        raise EOFError(GZIP_TRUNCATED)
+                    inflater.feed(data)
+                ret, _, chunk = inflater.inflate()
+                if chunk:
+                    yield chunk
+                if ret == Z_STREAM_END:
+                    break
+            # gzip trailer of current member, the next members are inflated with zlib module
+            data = inflater.unused_data()
+            while len(data) < 8:
+                more = log.read(GZIP_BLOCK_SIZE)
+                if not more:
+                    raise EOFError(GZIP_TRUNCATED)
+                data += more
+            yield from inflate_members(log, data[8:])
+    finally:
+        inflater.close()
+
+def get_gzip_index_path(log_path):
+    """
+    Return path of access point index stored next to gzip log
+    """
+    return log_path + 'idx'
+
+def load_gzip_index(log_path):
+    """
+    Load access points of gzip log if index is stored and log wasn't changed since,
+    otherwise return None. Malformed index is treated as missing
+    """
+    index_path = get_gzip_index_path(log_path)
+    if not os.path.isfile(index_path):
+        return None
+    log_stat = os.stat(log_path)
+    try:
+        with open(index_path, 'rb') as findex:
+            data = findex.read()
+        magic, size, mtime_ns, count = GZIP_INDEX_HEADER.unpack_from(data)
+        if magic != GZIP_INDEX_MAGIC:
+            raise ValueError('wrong magic')
+        points = []
+        pos = GZIP_INDEX_HEADER.size
+        for _ in range(count):
+            out_offset, in_offset, bits, window_size = GZIP_INDEX_POINT.unpack_from(data, pos)
+            pos += GZIP_INDEX_POINT.size
+            window = data[pos:pos + window_size]
+            pos += window_size
+            if (len(window) != window_size or bits > 7
+                    or len(zlib.decompress(window)) > GZIP_WINDOW_SIZE
+                    or points and out_offset <= points[-1][0]):
+                raise ValueError('malformed access point')
+            points.append((out_offset, in_offset, bits, window))
+        if pos != len(data):
+            raise ValueError('trailing data')
+    except (OSError, struct.error, zlib.error, ValueError) as error:
+        logging.warning(msg=f'Can not read gzip index {index_path}: {error}')
+        return None
+    if (size, mtime_ns) != (log_stat.st_size, log_stat.st_mtime_ns):
+        logging.info(msg=f'Gzip log changed since index {index_path} was built')
+        return None
+    return points
+
+def save_gzip_index(log_path, points):
+    """
+    Atomically save access points next to gzip log
+    """
+    index_path = get_gzip_index_path(log_path)
+    log_stat = os.stat(log_path)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as findex:
+            findex.write(GZIP_INDEX_HEADER.pack(GZIP_INDEX_MAGIC, log_stat.st_size,
+                                                log_stat.st_mtime_ns, len(points)))
+            for out_offset, in_offset, bits, window in points:
+                findex.write(GZIP_INDEX_POINT.pack(out_offset, in_offset, bits, len(window)))
+                findex.write(window)
+        os.replace(tmp_path, index_path)
+        logging.info(msg=f'Gzip index with {len(points)} access points saved to {index_path}')
+    except OSError as error:
+        logging.warning(msg=f'Can not save gzip index {index_path}: {error}')
+
+def chunks_to_lines(chunks, start=0, end=None, skip_first=False, binary=False):
+    """
+    Generator splitting stream of uncompressed chunks starting at offset start
+    to lines which start before end, lines are yielded without trailing newline.
+    First line is skipped if it's a tail of the line started before start
+    """
+    pos = start
+    tail = b''
+    for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if end is not None and pos >= end:
+                return
+            pos += len(line) + 1
+            if skip_first:
+                skip_first = False
+                continue
+            yield line if binary else line.decode('utf-8')
+    if tail and not skip_first and (end is None or pos < end):
+        yield tail if binary else tail.decode('utf-8')
+
+def read_gzip_chunk(log_path, point, end, binary=False):
+    """
+    Generator for reading lines of gzip file which start in uncompressed byte range
+    from access point offset to end
+    """
+    skip_first = point[0] > 0 and not zlib.decompress(point[3]).endswith(b'\n')
+    return chunks_to_lines(inflate_from_point(log_path, point), point[0], end,
+                           skip_first, binary)
+
+def is_binary(conf):
+    """
+    Return True if log lines are read and parsed as bytes, memory mapped log is read as bytes
+    """
+    mode = get_option(conf, 'READ_MODE')
+    if mode not in ('text', 'bytes'):
+        raise ValueError(f'Unknown read mode {mode}')
+    return mode == 'bytes' or get_flag(conf, 'MMAP')
+
+def get_reader(conf, log_path, start=0, end=None):
+    """
+    Return line generator for log file (or byte range of uncompressed one) according to config
+    """
+    if log_path.endswith('.gz') and get_flag(conf, 'GZIP_PIPELINE'):
+        return xreadlines_pipelined(log_path, is_binary(conf))
+    if log_path.endswith('.gz'):
+        return xreadlines(log_path, is_binary(conf))
+    if get_flag(conf, 'MMAP'):
+        return xreadlines_mmap(log_path, start, end)
+    if start or end is not None:
+        if end is None:
+            end = os.path.getsize(log_path)
+        return read_chunk(log_path, start, end, is_binary(conf))
+    return xreadlines(log_path, is_binary(conf))
+
+def compare_gzip_readers(conf, log_path):
+    """
+    Parse gzip log with plain and pipelined readers and log their throughput
+    """
+    size = os.path.getsize(log_path)/1024/1024
+    speed = {}
+    for name, reader in (('plain', xreadlines), ('pipelined', xreadlines_pipelined)):
+        start_time = time.time()
+        lines = parse_lines(conf, reader(log_path, is_binary(conf)))[1]
+        elapsed = max(time.time() - start_time, 1e-9)
+        speed[name] = lines/elapsed
+        logging.info(msg=f'{name} gzip reader: {lines} lines in {elapsed:.3f} s, '
+                         f'{speed[name]:.0f} lines/s, {size/elapsed:.2f} MB/s of compressed data')
+    logging.info(msg=f"Pipelined reader speedup {speed['pipelined']/max(speed['plain'], 1e-9):.2f}x")
+
+def read_chunk(log_path, start, end, binary=False):
+    """
+    Generator for reading lines of uncompressed file which start in byte range [start, end),
+    lines are not decoded if binary
+    """
+    with open(log_path, 'rb', buffering=BINARY_BUFFER_SIZE) as log:
+        log.seek(start)
+        pos = start
+        while pos < end:
+            line = log.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line if binary else line.decode('utf-8')
+
+def split_logfile(log_path, parts, start=0, end=None):
+    """
+    Split uncompressed file (or its byte range starting at line start) into
+    newline-aligned byte ranges.
+    Return list of (start, end) tuples
+    """
+    if end is None:
+        end = os.path.getsize(log_path)
+    offsets = [start]
+    with open(log_path, 'rb') as log:
+        for i in range(1, parts):
+            log.seek(max(start + (end-start)*i//parts, offsets[-1]))
+            if log.tell() > 0:
+                log.seek(log.tell()-1)
+                log.readline()
+            pos = log.tell()
+            if offsets[-1] < pos < end:
+                offsets.append(pos)
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def find_complete_end(log_path, start, size):
+    """
+    Return offset after the last newline in byte range [start, size) of file,
+    so a line which is still being written is left for the next run
+    """
+    with open(log_path, 'rb') as log:
+        pos = size
+        while pos > start:
+            block_start = max(start, pos - 65536)
+            log.seek(block_start)
+            block = log.read(pos - block_start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                return block_start + newline + 1
+            pos = block_start
+    return start
+
+def split_line_head(head, tail):
+    """
+    Split str or bytes text before and after quoted request into remote_addr, remote_user,
+    http_x_real_ip, time_local, status and body_bytes_sent.
+    Return None if it doesn't fit the same parts of LINEFORMAT_NAMED
+    """
+    text = isinstance(head, str)
+    space, dot, opening, closing = (' ', '.', ' [', '] ') if text else (b' ', b'.', b' [', b'] ')
+    head, _, time_local = head.partition(opening)
+    head = head.split(space)
+    tail = tail.split(space)
+    if len(head) != 4 or head[2] or not head[1] or not head[3] or not time_local.endswith(closing):
+        return None
+    if len(tail) != 4 or tail[0] or tail[3] or not tail[1] or not tail[2]:
+        return None
+    # \d of str and bytes patterns
+    is_digits = str.isdecimal if text else bytes.isdigit
+    octets = head[0].split(dot)
+    if len(octets) != 4 or not all(0 < len(octet) < 4 and is_digits(octet) for octet in octets):
+        return None
+    return head[0], head[1], head[3], time_local[:-2], tail[1], tail[2]
+
+def parse_line_fast(line, fields=REQUIRED_FIELDS):
+    """
+    Parse line of known nginx ui format by its quote-delimited structure.
+    Return dictionary with given fields or None if line doesn't fit the format
+    """
+    parts = line.split('"')
+    if len(parts) != 13:
+        return None
+    request_time = parts[12].strip()
+    if request_time.count('.') != 1 or not request_time.replace('.', '').isdecimal():
+        return None
+    request = parts[1]
+    # the same method stripping as (\bGET |POST \b)? group of LINEFORMAT_NAMED
+    if request.startswith('GET '):
+        request = request[4:]
+    elif request.startswith('POST ') and (request[5:6].isalnum() or request[5:6] == '_'):
+        request = request[5:]
+    head = split_line_head(parts[0], parts[2])
+    if head is None:
+        return None
+    if fields == REQUIRED_FIELDS:
+        return {'request': request, 'request_time': request_time}
+
+    values = dict(zip(LINE_FIELDS, (*head[:4], request, *head[4:], parts[3], parts[5],
+                                    parts[7], parts[9], parts[11], request_time)))
+    return {field: values[field] for field in fields}
+
+def parse_line(line, fields=REQUIRED_FIELDS, fast=True):
+    """
+    Parse line with fast parser falling back to LINEFORMAT_NAMED regex.
+    Return dictionary with given fields or None if line can not be parsed
+    """
+    if fast:
+        line_dict = parse_line_fast(line, fields)
+        if line_dict is not None:
+            return line_dict
+    data = re.search(LINEFORMAT_NAMED, line)
+    if data is None:
+        return None
+    return {field: data.group(field) for field in fields}
+
+def parse_line_bytes(line, fields, fast, urls):
+    """
+    Parse line read in bytes mode. Only url is decoded, once for each distinct url
+    memorized in urls dictionary of up to URL_CACHE_SIZE urls.
+    Lines are decoded entirely if other fields are needed.
+    Return dictionary with given fields or None if line can not be parsed or is not valid UTF-8
+    """
+    if fields != REQUIRED_FIELDS:
+        try:
+            return parse_line(line.decode('utf-8'), fields, fast)
+        except UnicodeDecodeError:
+            return None
+    request = request_time = None
+    parts = line.split(b'"') if fast else ()
+    if len(parts) == 13:
+        request_time = parts[12].strip()
+        if request_time.count(b'.') == 1 and request_time.replace(b'.', b'').isdigit() and \
+                split_line_head(parts[0], parts[2]) is not None:
+            request = parts[1]
+            # the same method stripping as in parse_line_fast
+            if request.startswith(b'GET '):
+                request = request[4:]
+            elif request.startswith(b'POST ') and (request[5:6].isalnum() or request[5:6] == b'_'):
+                request = request[5:]
+    if request is None:
+        data = LINEFORMAT_NAMED_BYTES.search(line)
+        if data is None:
+            return None
+        request, request_time = data.group('request', 'request_time')
+    url = urls.get(request)
+    if url is None:
+        if len(urls) >= URL_CACHE_SIZE:
+            urls.clear()
+        try:
+            url = urls[request] = request.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    return {'request': url, 'request_time': request_time}
+
+def add_time(stat, req_time):
+    """
+    Add request time to per-url aggregate
+    """
+    if 'times' in stat:
+        stat['times'].append(req_time)
+        return
+    stat['count'] += 1
+    stat['time_sum'] += req_time
+    if stat['time_max'] < req_time:
+        stat['time_max'] = req_time
+    stat['sketch'].add(req_time)
+
+def empty_result():
+    """
+    Return result of parsing empty log
+    """
+    return {}, 0, 0, 0, {}
+
+def add_dimensions(dims, dimensions, line_dict, req_time, accuracy):
+    """
+    Add request time (and bytes sent) to aggregates of each dimension
+    """
+    for name, dimension in dimensions:
+        key = line_dict[dimension.field]
+        if dimension.key is not None:
+            key = dimension.key(key)
+        stats = dims[name]
+        if key not in stats:
+            stats[key] = new_stat(accuracy)
+            if dimension.bytes_sent:
+                stats[key]['bytes'] = 0
+        add_time(stats[key], req_time)
+        if dimension.bytes_sent and line_dict['body_bytes_sent'].isdigit():
+            stats[key]['bytes'] += int(line_dict['body_bytes_sent'])
+
+def parse_lines(conf, log_lines, spill=None, metrics=None):
+    """
+    Parse lines and aggregate request times by url and other dimensions of GROUP_BY in one pass.
+    Lines are taken by blocks, reading (decompression and decoding), parsing and aggregation
+    of each block are measured as read, parse and aggregate stages of metrics.
+    Per-url aggregates are written to spill when it's full, only the rest of them is returned.
+    Return dictionary with each url, number of total and processed rows, total_time,
+    and dictionary of aggregates for each other dimension
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    accuracy = get_accuracy(conf)
+    fields = get_fields(conf)
+    fast = get_option(conf, 'PARSER') == 'fast'
+    normalize = get_normalizer(conf)
+    capacity = get_capacity(conf)
+    heavy_hitters = (HeavyHitters(capacity, float(get_option(conf, 'SKETCH_ACCURACY')))
+                     if capacity else None)
+    columnar = ColumnarStats() if get_backend(conf) == 'numpy' else None
+    dimensions = get_dimensions(conf)
+    dims = {name: {} for name, _ in dimensions}
+    binary = is_binary(conf)
+    urls = {}
     dct_stat = {}
     total = processed = total_time = 0
-    for line in log_lines:
-        data = re.search(LINEFORMAT_NAMED, line)
-        total += 1
-        if data:
-            processed += 1
-            line_dict = data.groupdict()
-            url = line_dict['request']
-            if url not in dct_stat:
-                dct_stat[url] = {'times': []}
-            req_time = float(line_dict['request_time'])
-            dct_stat[url]['times'].append(req_time)
-            total_time += req_time
+    log_lines = iter(log_lines)
+    while True:
+        with metrics.stage('read'):
+            block = list(islice(log_lines, TIMED_BLOCK_SIZE))
+        if not block:
+            break
+        with metrics.stage('parse'):
+            if binary:
+                block = [parse_line_bytes(line, fields, fast, urls) for line in block]
+            else:
+                block = [parse_line(line, fields, fast) for line in block]
+        with metrics.stage('aggregate'):
+            for line_dict in block:
+                total += 1
+                if not line_dict:
+                    continue
+                processed += 1
+                url = line_dict['request']
+                if normalize is not None:
+                    url = normalize(url)
+                req_time = float(line_dict['request_time'])
+                total_time += req_time
+                if dimensions:
+                    add_dimensions(dims, dimensions, line_dict, req_time, accuracy)
+                if heavy_hitters is not None:
+                    heavy_hitters.add(url, req_time)
+                    continue
+                if columnar is not None:
+                    columnar.add(url, req_time)
+                    continue
+                if url not in dct_stat:
+                    dct_stat[url] = new_stat(accuracy)
+                    if spill is not None:
+                        dct_stat[url]['seq'] = spill.next_seq()
+                add_time(dct_stat[url], req_time)
+                if spill is not None and spill.is_full(dct_stat, total):
+                    spill.write(dct_stat)
+                    dct_stat = {}
+    if heavy_hitters is not None:
+        dct_stat = heavy_hitters.stats
+    if columnar is not None:
+        dct_stat = columnar
+    return dct_stat, total, processed, total_time, dims
+
+def process_chunk(chunk):
+    """
+    Worker function: parse byte range (conf, log_path, start, end) of log file
+    """
+    conf, log_path, start, end = chunk
+    return parse_lines(conf, get_reader(conf, log_path, start, end))
+
+def merge_stat(stat, part):
+    """
+    Merge partial aggregate of one url into stat
+    """
+    if 'times' in part:
+        stat['times'].extend(part['times'])
+    else:
+        stat['count'] += part['count']
+        stat['time_sum'] += part['time_sum']
+        stat['time_max'] = max(stat['time_max'], part['time_max'])
+        stat['sketch'].merge(part['sketch'])
+    if 'weight' in part:
+        stat['weight'] += part['weight']
+        stat['error'] += part['error']
+    if 'bytes' in part:
+        stat['bytes'] += part['bytes']
+
+def merge_heavy_hitters(dct_stat, part_stat, capacity):
+    """
+    Merge two heavy hitters summaries keeping at most capacity urls.
+    Url missing in a full summary could have up to its minimal weight there,
+    so this weight is added to url weight and error
+    """
+    def min_weight(stats):
+        if len(stats) < capacity:
+            return 0.0
+        return min(stat['weight'] for stat in stats.values())
+
+    dct_min, part_min = min_weight(dct_stat), min_weight(part_stat)
+    for url, stat in dct_stat.items():
+        if url not in part_stat:
+            stat['weight'] += part_min
+            stat['error'] += part_min
+    for url, stat in part_stat.items():
+        if url in dct_stat:
+            merge_stat(dct_stat[url], stat)
+        else:
+            stat['weight'] += dct_min
+            stat['error'] += dct_min
+            dct_stat[url] = stat
+    if len(dct_stat) > capacity:
+        keep = set(heapq.nlargest(capacity, dct_stat, key=lambda url: dct_stat[url]['weight']))
+        for url in [url for url in dct_stat if url not in keep]:
+            del dct_stat[url]
+    return dct_stat
+
+def merge_stats(dct_stat, part_stat, capacity=0):
+    """
+    Merge partial per-url aggregates into dct_stat,
+    capacity is number of counters for heavy hitters summaries
+    """
+    if isinstance(part_stat, ColumnarStats):
+        if not len(dct_stat):
+            return part_stat
+        return dct_stat.merge(part_stat)
+    if capacity:
+        return merge_heavy_hitters(dct_stat, part_stat, capacity)
+    for url, stat in part_stat.items():
+        if url not in dct_stat:
+            dct_stat[url] = stat
+        else:
+            merge_stat(dct_stat[url], stat)
+    return dct_stat
+
+def merge_results(conf, result, part):
+    """
+    Merge partial result of parse_lines into result in order of log lines
+    """
+    dct_stat, total, processed, total_time, dims = result
+    part_stat, part_total, part_processed, part_time, part_dims = part
+    for name, stats in part_dims.items():
+        dims[name] = merge_stats(dims.get(name, {}), stats)
+    return (merge_stats(dct_stat, part_stat, get_capacity(conf)), total + part_total,
+            processed + part_processed, total_time + part_time, dims)
+
+def process_parallel(conf, log_path, workers, start=0, end=None, metrics=None):
+    """
+    Parse uncompressed log file (or its byte range) by chunks in process pool
+    and merge results in file order
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    chunks = [(conf, log_path, chunk_start, chunk_end)
+              for chunk_start, chunk_end in split_logfile(log_path, workers*CHUNKS_PER_WORKER,
+                                                          start, end)]
+    metrics.mark_in_workers('lines are processed in worker processes')
+    result = empty_result()
+    with Pool(workers) as pool:
+        for part in pool.imap(process_chunk, chunks):
+            result = merge_results(conf, result, part)
+    return result
+
+def process_gzip_chunk(chunk):
+    """
+    Worker function: parse lines of gzip log (conf, log_path, point, end)
+    starting from access point up to uncompressed offset end
+    """
+    conf, log_path, point, end = chunk
+    return parse_lines(conf, read_gzip_chunk(log_path, point, end, is_binary(conf)))
+
+def process_gzip_indexed(conf, log_path, workers, metrics=None):
+    """
+    Parse gzip log by chunks starting at access points of its index in process pool.
+    Log without index is parsed sequentially and its index is built meanwhile
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    points = load_gzip_index(log_path)
+    if not points or points[0][0] != 0:
+        points = []
+        span = int(float(get_option(conf, 'GZIP_INDEX_SPAN_MB'))*1024*1024)
+        chunks = inflate_indexing(log_path, points, span)
+        result = parse_lines(conf, chunks_to_lines(chunks, binary=is_binary(conf)),
+                             metrics=metrics)
+        save_gzip_index(log_path, points)
+        return result
+    if workers <= 1:
+        return parse_lines(conf, get_reader(conf, log_path), metrics=metrics)
+    step = max(1, len(points)//(workers*CHUNKS_PER_WORKER))
+    starts = points[::step]
+    chunks = [(conf, log_path, point, next_point[0])
+              for point, next_point in zip(starts, starts[1:])]
+    chunks.append((conf, log_path, starts[-1], None))
+    logging.info(msg=f'Parsing gzip log by {len(chunks)} chunks in {workers} worker processes')
+    metrics.mark_in_workers('gzip chunks are processed in worker processes')
+    result = empty_result()
+    with Pool(workers) as pool:
+        for part in pool.imap(process_gzip_chunk, chunks):
+            result = merge_results(conf, result, part)
+    return result
+
+def parse_logfile(conf, log_path, start=0, end=None, metrics=None):
+    """
+    Parse whole log file or byte range of uncompressed one, in worker processes if configured
+    """
+    workers = int(get_option(conf, 'WORKERS'))
+    if log_path.endswith('.gz'):
+        reader = 'pipelined' if get_flag(conf, 'GZIP_PIPELINE') else 'plain'
+        start_time = time.time()
+        if get_flag(conf, 'GZIP_INDEX') and libz is not None:
+            reader = 'indexed'
+            result = process_gzip_indexed(conf, log_path, workers, metrics)
+        else:
+            result = parse_lines(conf, get_reader(conf, log_path), metrics=metrics)
+        elapsed = max(time.time() - start_time, 1e-9)
+        logging.info(msg=f'{reader} gzip reader: {result[1]/elapsed:.0f} lines/s, '
+                         f'{os.path.getsize(log_path)/1024/1024/elapsed:.2f} MB/s '
+                         f'of compressed data')
+        return result
+    if workers > 1:
+        logging.info(msg=f'Parsing log in {workers} worker processes')
+        return process_parallel(conf, log_path, workers, start, end, metrics)
+    return parse_lines(conf, get_reader(conf, log_path, start, end), metrics=metrics)
+
+def pack_stats(dct_stat):
+    """
+    Convert lists of request times to typed arrays for compact pickling
+    """
+    if isinstance(dct_stat, ColumnarStats):
+        return dct_stat
+    return {url: dict(stat, times=array('d', stat['times'])) if 'times' in stat else stat
+            for url, stat in dct_stat.items()}
+
+def unpack_stats(dct_stat):
+    """
+    Restore per-url aggregates packed by pack_stats
+    """
+    if isinstance(dct_stat, ColumnarStats):
+        return dct_stat
+    for stat in dct_stat.values():
+        if 'times' in stat:
+            stat['times'] = stat['times'].tolist()
+    return dct_stat
+
+def get_cache_path(conf, log_path):
+    """
+    Return path of cached aggregates for log file, keyed by its name, size, mtime
+    and aggregation options
+    """
+    log_stat = os.stat(log_path)
+    options = repr(list(get_aggregate_options(conf).values()))
+    options_hash = hashlib.md5(options.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(get_option(conf, 'CACHE_DIR'),
+                        f'{os.path.basename(log_path)}-{log_stat.st_size}-'
+                        f'{log_stat.st_mtime_ns}-{options_hash}.cache')
+
+def evict_cache(cache_dir, max_size):
+    """
+    Remove least recently used cache files until total size is not more than max_size bytes
+    """
+    files = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.cache'):
+            try:
+                file_stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            files.append((file_stat.st_mtime, file_stat.st_size, name))
+    total_size = sum(size for _, size, _ in files)
+    for _, size, name in sorted(files):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+            logging.info(msg=f'Cache file {name} evicted')
+        except OSError:
+            pass
+        total_size -= size
+
+def parse_logfile_cached(conf, log_path, metrics=None):
+    """
+    Load aggregates of log file from cache or parse it and save result to cache
+    """
+    if not get_option(conf, 'CACHE_DIR'):
+        return parse_logfile(conf, log_path, metrics=metrics)
+    cache_path = get_cache_path(conf, log_path)
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'rb') as fcache:
+                dct_stat, total, processed, total_time, dims = pickle.load(fcache)
+            # mtime of cache file is its last use time for eviction
+            os.utime(cache_path)
+            logging.info(msg=f'Aggregates loaded from cache {cache_path}')
+            return unpack_stats(dct_stat), total, processed, total_time, dims
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as error:
+            logging.warning(msg=f'Can not read cache {cache_path}: {error}')
+    dct_stat, total, processed, total_time, dims = parse_logfile(conf, log_path, metrics=metrics)
+    os.makedirs(get_option(conf, 'CACHE_DIR'), exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fcache:
+        pickle.dump((pack_stats(dct_stat), total, processed, total_time, dims), fcache,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    evict_cache(get_option(conf, 'CACHE_DIR'), float(get_option(conf, 'CACHE_SIZE_MB'))*1024*1024)
+    return dct_stat, total, processed, total_time, dims
+
+def get_checkpoint_path(conf, log_name):
+    """
+    Return path of checkpoint file for given log
+    """
+    return os.path.join(conf['REPORT_DIR'], f'.{log_name}.checkpoint')
+
+def get_log_head_hash(log_path, size):
+    """
+    Hash first bytes of log file to detect file replaced with the same inode
+    """
+    with open(log_path, 'rb') as log:
+        return hashlib.md5(log.read(min(size, CHECKPOINT_HEAD_SIZE))).hexdigest()
+
+def load_checkpoint(conf, log_path, checkpoint_path, log_stat):
+    """
+    Load checkpoint for log file if it's still valid, otherwise return None
+    """
+    if not os.path.isfile(checkpoint_path):
+        return None
+    try:
+        with open(checkpoint_path, 'rb') as fcheckpoint:
+            checkpoint = pickle.load(fcheckpoint)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        logging.warning(msg=f'Can not read checkpoint {checkpoint_path}, starting over')
+        return None
+    if checkpoint['options'] != get_aggregate_options(conf):
+        logging.info(msg='Aggregation options changed since checkpoint, starting over')
+        return None
+    if (checkpoint['inode'] != log_stat.st_ino or checkpoint['dev'] != log_stat.st_dev
+            or log_stat.st_size < checkpoint['offset']
+            or checkpoint['head'] != get_log_head_hash(log_path, checkpoint['offset'])):
+        logging.info(msg='Log file was rotated or truncated since checkpoint, starting over')
+        return None
+    checkpoint['stat'] = unpack_stats(checkpoint['stat'])
+    checkpoint['dims'] = {name: unpack_stats(stats) for name, stats in checkpoint['dims'].items()}
+    return checkpoint
+
+def save_checkpoint(conf, log_path, checkpoint_path, log_stat, offset, result):
+    """
+    Atomically save parsed offset, log file fingerprint and partial aggregates.
+    Request times are stored as typed arrays, so the whole checkpoint is rewritten
+    at about memory copy speed
+    """
+    dct_stat, total, processed, total_time, dims = result
+    checkpoint = {'inode': log_stat.st_ino,
+                  'dev': log_stat.st_dev,
+                  'offset': offset,
+                  'head': get_log_head_hash(log_path, offset),
+                  'options': get_aggregate_options(conf),
+                  'total': total,
+                  'processed': processed,
+                  'total_time': total_time,
+                  'stat': pack_stats(dct_stat),
+                  'dims': {name: pack_stats(stats) for name, stats in dims.items()}}
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'wb') as fcheckpoint:
+        pickle.dump(checkpoint, fcheckpoint, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, checkpoint_path)
+
+def process_incremental(conf, log_path, checkpoint_path, metrics=None):
+    """
+    Parse only bytes appended to uncompressed log since the last checkpoint
+    and merge them with saved partial aggregates
+    """
+    log_stat = os.stat(log_path)
+    checkpoint = load_checkpoint(conf, log_path, checkpoint_path, log_stat)
+    if checkpoint is None:
+        start, result = 0, empty_result()
+    else:
+        start = checkpoint['offset']
+        result = (checkpoint['stat'], checkpoint['total'], checkpoint['processed'],
+                  checkpoint['total_time'], checkpoint['dims'])
+    end = find_complete_end(log_path, start, log_stat.st_size)
+    logging.info(msg=f'Parsing log bytes from {start} to {end}')
+    result = merge_results(conf, result, parse_logfile(conf, log_path, start, end, metrics))
+    save_checkpoint(conf, log_path, checkpoint_path, log_stat, end, result)
+    return result
+
+class SampleDesign():
+    """
+    Sums over sampled blocks of log needed to scale per-url counts and time sums
+    up to the whole log and to estimate their confidence intervals.
+    Blocks are clusters of lines, systematic sample of them is treated as simple random one
+    """
+    def __init__(self):
+        self.blocks = 0
+        self.total_blocks = 0
+        self.time_sum = 0.0
+        self.time_sq = 0.0
+        self.sums = {}
+
+    def add_block(self, dct_stat, block_time):
+        """
+        Add per-url aggregates of sampled block with total request time block_time
+        """
+        self.blocks += 1
+        self.time_sum += block_time
+        self.time_sq += block_time*block_time
+        for key, stat in dct_stat.items():
+            if 'times' in stat:
+                count, time_sum = len(stat['times']), sum(stat['times'])
+            else:
+                count, time_sum = stat['count'], stat['time_sum']
+            sums = self.sums.setdefault(key, [0, 0.0, 0.0])
+            sums[0] += count*count
+            sums[1] += time_sum*time_sum
+            sums[2] += time_sum*block_time
+
+    @property
+    def scale(self):
+        """
+        Ratio of the number of all blocks to the number of sampled ones
+        """
+        return self.total_blocks/self.blocks if self.blocks else 0.0
+
+    def intervals(self, key, count, time_sum):
+        """
+        Return half-widths of confidence intervals of estimated total count, time_sum
+        and time_perc of key with given sampled count and time_sum,
+        None if there are less than two sampled blocks
+        """
+        blocks = self.blocks
+        if blocks >= self.total_blocks:
+            return 0.0, 0.0, 0.0
+        if blocks < 2:
+            return None, None, None
+        count_sq, time_sq, cross = self.sums.get(key, (0, 0.0, 0.0))
+        fpc = 1 - blocks/self.total_blocks
+
+        def total_interval(total, total_sq):
+            variance = (total_sq - total*total/blocks)/(blocks - 1)
+            return SAMPLE_Z*self.total_blocks*math.sqrt(max(fpc*variance/blocks, 0.0))
+
+        perc_interval = 0.0
+        if self.time_sum:
+            # ratio estimator of time_sum share
+            ratio = time_sum/self.time_sum
+            variance = (time_sq - 2*ratio*cross + ratio*ratio*self.time_sq)/(blocks - 1)
+            perc_interval = 100*SAMPLE_Z*math.sqrt(max(fpc*variance/blocks, 0.0))/(
+                self.time_sum/blocks)
+        return total_interval(count, count_sq), total_interval(time_sum, time_sq), perc_interval
+
+def is_sampled(index, fraction, offset):
+    """
+    Return True if block with given index is in systematic sample with random offset in [0, 1)
+    """
+    return math.floor((index + 1)*fraction + offset) > math.floor(index*fraction + offset)
+
+def sample_blocks(conf, log_path, fraction, offset):
+    """
+    Generator of (sampled, lines) for blocks of log. Blocks of uncompressed log are
+    newline-aligned byte ranges and not sampled ones are not read at all,
+    gzip log is inflated entirely and split into blocks of SAMPLE_BLOCK_LINES lines,
+    lines of not sampled ones are only counted
+    """
+    if log_path.endswith('.gz'):
+        reader = get_reader(conf, log_path)
+        index = 0
+        while True:
+            if is_sampled(index, fraction, offset):
+                block = list(islice(reader, SAMPLE_BLOCK_LINES))
+                if not block:
+                    return
+                yield True, block
+            else:
+                lines = sum(1 for _ in islice(reader, SAMPLE_BLOCK_LINES))
+                if not lines:
+                    return
+                yield False, lines
+            index += 1
+    size = os.path.getsize(log_path)
+    blocks = max(math.ceil(size/SAMPLE_BLOCK_SIZE), math.ceil(SAMPLE_MIN_BLOCKS/fraction))
+    for index, (start, end) in enumerate(split_logfile(log_path, blocks)):
+        if is_sampled(index, fraction, offset):
+            yield True, get_reader(conf, log_path, start, end)
+        else:
+            yield False, None
+
+def process_sample(conf, log_path, rnd=None, metrics=None):
+    """
+    Parse systematic sample of blocks of log file covering SAMPLE fraction of it.
+    Counts and sums are scaled up to the whole log, each per-url (and per-dimension)
+    aggregate gets 'sample' design used to calculate confidence intervals.
+    Return the same as parse_logfile
+    """
+    fraction = float(get_option(conf, 'SAMPLE'))
+    offset = (rnd or random).random()
+    # sampled blocks are merged exactly, per-block sums are needed for intervals
+    conf = dict(conf, HEAVY_HITTERS=0, BACKEND='python')
+    designs = {name: SampleDesign() for name, _ in get_dimensions(conf)}
+    design = SampleDesign()
+    result = empty_result()
+    total_blocks = 0
+    for sampled, lines in sample_blocks(conf, log_path, fraction, offset):
+        total_blocks += 1
+        if not sampled:
+            continue
+        part = parse_lines(conf, lines, metrics=metrics)
+        design.add_block(part[0], part[3])
+        for name, stats in part[4].items():
+            designs[name].add_block(stats, part[3])
+        result = merge_results(conf, result, part)
+    dct_stat, total, processed, total_time, dims = result
+    logging.info(msg=f'{design.blocks} of {total_blocks} blocks of log sampled')
+    for table, table_design in [(dct_stat, design)] + [(dims[name], designs[name])
+                                                       for name in dims]:
+        table_design.total_blocks = total_blocks
+        for stat in table.values():
+            stat['sample'] = table_design
+    scale = design.scale
+    return dct_stat, round(total*scale), round(processed*scale), total_time*scale, dims
+
+class Spill():
+    """
+    Hash partitioned run files of per-url aggregates for memory budgeted aggregation.
+    Each write appends one pickled dictionary to every partition, so records of url
+    in partition are in log order. Urls get sequence numbers of their first appearance
+    to keep order of urls with equal time_sum in report
+    """
+    def __init__(self, conf):
+        self.max_entries = int(get_option(conf, 'SPILL_ENTRIES'))
+        self.max_rss = float(get_option(conf, 'SPILL_RSS_MB'))
+        self.spill_dir = tempfile.mkdtemp(prefix='log_analyzer-spill-',
+                                          dir=get_option(conf, 'SPILL_DIR') or None)
+        self.paths = [os.path.join(self.spill_dir, f'part-{i}.run')
+                      for i in range(int(get_option(conf, 'SPILL_PARTITIONS')))]
+        self.files = [open(path, 'wb') for path in self.paths]
+        self.seq = 0
+        self.writes = 0
+        self.urls = 0
+
+    def next_seq(self):
+        """
+        Return sequence number for new url
+        """
+        self.seq += 1
+        return self.seq
+
+    def is_full(self, dct_stat, lines):
+        """
+        Return True if in-memory aggregates exceed entry limit, or memory limit
+        checked every SPILL_CHECK_LINES lines. Memory freed by spill is rarely
+        returned to OS, so after the memory limit is hit the number of urls
+        in memory at that moment becomes entry limit instead
+        """
+        if self.max_entries and len(dct_stat) >= self.max_entries:
+            return True
+        if (self.max_rss and lines % SPILL_CHECK_LINES == 0 and dct_stat
+                and current_rss() >= self.max_rss):
+            logging.info(msg=f'Memory budget {self.max_rss} MB is hit with {len(dct_stat)} '
+                             f'urls in memory, spilling by number of urls further')
+            self.max_entries = len(dct_stat)
+            self.max_rss = 0
+            return True
+        return False
+
+    def write(self, dct_stat):
+        """
+        Append aggregates to partitions by hash of url
+        """
+        parts = [{} for _ in self.files]
+        for url, stat in dct_stat.items():
+            parts[zlib.crc32(url.encode('utf-8')) % len(parts)][url] = stat
+        for part, fpart in zip(parts, self.files):
+            if part:
+                pickle.dump(part, fpart, protocol=pickle.HIGHEST_PROTOCOL)
+        self.writes += 1
+
+    def read(self, index):
+        """
+        Merge records of partition, return dictionary of per-url aggregates
+        """
+        merged = {}
+        with open(self.paths[index], 'rb') as fpart:
+            while True:
+                try:
+                    part = pickle.load(fpart)
+                except EOFError:
+                    break
+                for url, stat in part.items():
+                    if url in merged:
+                        merge_stat(merged[url], stat)
+                    else:
+                        merged[url] = stat
+        return merged
+
+    def merge_top(self, size):
+        """
+        Merge partitions one at a time keeping aggregates of top size urls by rounded time_sum.
+        Return them in order of first appearance, like in-memory aggregation gives them
+        """
+        for fpart in self.files:
+            fpart.close()
+        top = []
+        for index in range(len(self.paths)):
+            merged = self.read(index)
+            self.urls += len(merged)
+            candidates = [(-report_time_sum(stat), stat['seq'], url, stat)
+                          for url, stat in merged.items()]
+            top = heapq.nsmallest(size, top + candidates)
+        return {url: stat for _, _, url, stat in sorted(top, key=lambda item: item[1])}
+
+    def close(self):
+        """
+        Remove run files
+        """
+        for fpart in self.files:
+            fpart.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+def report_time_sum(stat):
+    """
+    Return time_sum of per-url aggregate rounded like in report row
+    """
+    if 'times' in stat:
+        stat['times'].sort()
+        return round(sum(stat['times']), 3)
+    return round(stat['time_sum'], 3)
+
+def is_spilling(conf):
+    """
+    Return True if aggregation is memory budgeted
+    """
+    limited = (int(get_option(conf, 'SPILL_ENTRIES')) > 0
+               or float(get_option(conf, 'SPILL_RSS_MB')) > 0)
+    return limited and get_backend(conf) == 'python' and not get_capacity(conf)
+
+def process_spilled(conf, log_path, metrics=None):
+    """
+    Parse log sequentially spilling per-url aggregates to disk partitions when memory
+    budget is exceeded, then merge partitions one by one.
+    Return the same as parse_logfile with aggregates of top REPORT_SIZE urls only
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    spill = Spill(conf)
+    try:
+        dct_stat, total, processed, total_time, dims = parse_lines(
+            conf, get_reader(conf, log_path), spill, metrics)
+        spill.write(dct_stat)
+        with metrics.stage('merge'):
+            dct_stat = spill.merge_top(int(conf['REPORT_SIZE']))
+        logging.info(msg=f'Aggregates of {spill.urls} distinct urls spilled {spill.writes} '
+                         f'times to {len(spill.paths)} partitions')
+    finally:
+        spill.close()
+    return dct_stat, total, processed, total_time, dims
+
+def is_sampling(conf):
+    """
+    Return True if only a sample of log is parsed
+    """
+    return 0 < float(get_option(conf, 'SAMPLE')) < 1
+
+def process_logfile(conf, latest_log, metrics=None):
+    """
+    Read log file and parse line by line, stages are measured in metrics.
+    Return dictionary with each row, number of processed rows, total_time taken by requests,
+    and dictionary of aggregates for each other dimension
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    logging.info(msg=f'Starting log_analyzer with config {str(conf)}')
+    logging.info(msg=f'Latest log date is {latest_log.date}')
+    log_path = conf['LOG_DIR']+'/'+latest_log.name
+    if is_sampling(conf):
+        dct_stat, total, processed, total_time, dims = process_sample(conf, log_path,
+                                                                      metrics=metrics)
+    elif is_spilling(conf):
+        dct_stat, total, processed, total_time, dims = process_spilled(conf, log_path, metrics)
+    elif get_flag(conf, 'INCREMENTAL') and not log_path.endswith('.gz'):
+        dct_stat, total, processed, total_time, dims = process_incremental(
+            conf, log_path, get_checkpoint_path(conf, latest_log.name), metrics)
+    else:
+        dct_stat, total, processed, total_time, dims = parse_logfile_cached(conf, log_path,
+                                                                            metrics)
+    metrics.lines = total
     logging.info(msg=f"{processed} of {total} lines processed")
     if total != processed:
         logging.warning(msg=f'''{total-processed} rows not parsed properly.
     Perhaps due to the changed log-row format.''')
-    return dct_stat, processed, total_time
+    return dct_stat, processed, total_time, dims
+
+def process_log_task(task):
+    """
+    Worker function: parse whole log file (conf, log_path) in current process
+    """
+    conf, log_path = task
+    return parse_logfile_cached(dict(conf, WORKERS=1), log_path)
 
-def calc_stat_top_urls(conf, dct_stat, processed, total_time):
+def process_batch(conf, logs, metrics=None):
     """
-    Calculate statistic data and get top urls
+    Parse several log files, one file per worker process, and merge results in date order.
+    Return the same as process_logfile
     """
-    for url in dct_stat:
-        dct_stat[url]['times'].sort()
-        dct_stat[url]['count'] = len(dct_stat[url]['times'])
-        dct_stat[url]['count_perc'] = round(dct_stat[url]['count']/processed*100, 3)
-        dct_stat[url]['time_sum'] = round(sum(dct_stat[url]['times']), 3)
+    if metrics is None:
+        metrics = StageMetrics()
+    logging.info(msg=f'Starting log_analyzer with config {str(conf)}')
+    logging.info(msg=f'Batch of {len(logs)} logs from {logs[0].date} to {logs[-1].date}')
+    tasks = [(conf, os.path.join(conf['LOG_DIR'], log.name)) for log in logs]
+    workers = max(1, min(int(get_option(conf, 'WORKERS')), len(tasks)))
+    metrics.mark_in_workers('logs are processed in worker processes')
+    result = empty_result()
+    with Pool(workers) as pool:
+        for log, part in zip(logs, pool.imap(process_log_task, tasks)):
+            logging.info(msg=f"{log.name}: {part[2]} of {part[1]} lines processed")
+            result = merge_results(conf, result, part)
+    dct_stat, total, processed, total_time, dims = result
+    metrics.lines = total
+    logging.info(msg=f"{processed} of {total} lines processed")
+    if total != processed:
+        logging.warning(msg=f'''{total-processed} rows not parsed properly.
+    Perhaps due to the changed log-row format.''')
+    return dct_stat, processed, total_time, dims
+
+def calc_stat_top_urls_numpy(conf, columnar, processed, total_time, size=None, metrics=None):
+    """
+    Calculate statistic data of columnar stats with vectorized group-by
+    and get top urls. Rows are the same as calc_stat_top_urls gives for exact aggregation
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    if not len(columnar.times):
+        return []
+    percentiles = get_percentiles(conf)
+    codes = np.frombuffer(columnar.url_codes, dtype='I')
+    order = np.lexsort((np.frombuffer(columnar.times, dtype='d'), codes))
+    codes = codes[order]
+    times = np.frombuffer(columnar.times, dtype='d')[order]
+    # all urls have at least one time, so groups are codes 0..len(urls)-1
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    counts = np.diff(np.r_[starts, len(times)])
+    time_sums = np.add.reduceat(times, starts)
+    time_maxs = times[starts + counts - 1]
+    middle = starts + (counts-1)//2
+    time_meds = np.where(counts % 2 == 1, times[middle],
+                         (times[middle] + times[np.minimum(middle+1, len(times)-1)])/2)
+    time_percs = []
+    for perc in percentiles:
+        pos = (counts-1)*perc/100
+        low = pos.astype(np.int64)
+        high = np.minimum(low+1, counts-1)
+        time_percs.append(times[starts+low] + (times[starts+high]-times[starts+low])*(pos-low))
+
+    time_sums = [round(time_sum, 3) for time_sum in time_sums.tolist()]
+    with metrics.stage('sort'):
+        top_codes = np.argsort(-np.array(time_sums), kind='stable')[:get_top_size(conf, size)]
+    for code in top_codes.tolist():
+        url = columnar.urls[code]
+        count = int(counts[code])
+        row = {'count': count}
+        row['count_perc'] = round(count/processed*100, 3)
+        row['time_sum'] = time_sums[code]
+        row['time_perc'] = round(row['time_sum']/total_time*100, 3)
+        row['time_avg'] = round(row['time_sum']/count, 3)
+        row['time_max'] = float(time_maxs[code])
+        row['time_med'] = round(float(time_meds[code]), 3)
+        for perc, values in zip(percentiles, time_percs):
+            row[percentile_name(perc)] = round(float(values[code]), 3)
+        row['url'] = url
+        columnar.rows[url] = row
+    return [columnar.urls[code] for code in top_codes.tolist()]
+
+def round_ci(interval):
+    """
+    Round half-width of confidence interval which is None if it can not be estimated
+    """
+    return None if interval is None else round(interval, 3)
+
+def get_top_size(conf, size):
+    """
+    Return number of top rows, REPORT_SIZE unless size is given
+    """
+    return int(conf['REPORT_SIZE']) if size is None else size
+
+def calc_stat_top_urls(conf, dct_stat, processed, total_time, key='url', size=None,
+                       metrics=None):
+    """
+    Calculate statistic data and get top urls (or top values of other dimension named key).
+    Up to size urls are returned, REPORT_SIZE by default
+    """
+    if isinstance(dct_stat, ColumnarStats):
+        return calc_stat_top_urls_numpy(conf, dct_stat, processed, total_time, size, metrics)
+    if metrics is None:
+        metrics = StageMetrics()
+    percentiles = get_percentiles(conf)
+    for url, stat in dct_stat.items():
+        if 'times' in stat:
+            times = stat['times']
+            times.sort()
+            count = len(times)
+            time_sum = sum(times)
+            time_max = times[-1]
+            time_med = median(times)
+            time_percs = [percentile(times, perc) for perc in percentiles]
+        else:
+            count = stat['count']
+            time_sum = stat['time_sum']
+            time_max = stat['time_max']
+            time_med = stat['sketch'].quantile(0.5)
+            time_percs = [stat['sketch'].quantile(perc/100) for perc in percentiles]
+        if 'sample' in stat:
+            intervals = stat['sample'].intervals(url, count, time_sum)
+            count = round(count*stat['sample'].scale)
+            time_sum *= stat['sample'].scale
+        time_avg = round(time_sum, 3)/count
+        if 'weight' in stat:
+            # heavy hitters estimate, samples above are seen since url was monitored
+            time_avg = time_sum/count
+            time_sum = stat['weight']
+        dct_stat[url] = {'count': count}
+        if 'sample' in stat:
+            dct_stat[url]['count_ci'] = round_ci(intervals[0])
+        dct_stat[url]['count_perc'] = round(count/processed*100, 3)
+        dct_stat[url]['time_sum'] = round(time_sum, 3)
+        if 'sample' in stat:
+            dct_stat[url]['time_sum_ci'] = round_ci(intervals[1])
+        if 'weight' in stat:
+            dct_stat[url]['time_sum_error'] = round(stat['error'], 3)
+        if 'bytes' in stat:
+            dct_stat[url]['bytes_sum'] = stat['bytes']
         dct_stat[url]['time_perc'] = round(dct_stat[url]['time_sum']/total_time*100, 3)
-        dct_stat[url]['time_avg'] = round(dct_stat[url]['time_sum']/dct_stat[url]['count'], 3)
-        dct_stat[url]['time_max'] = dct_stat[url]['times'][-1]
-        dct_stat[url]['time_med'] = round(median(dct_stat[url]['times']), 3)
-        dct_stat[url]['url'] = url
-        del dct_stat[url]['times']
-    return sorted(dct_stat.keys(),
-                  key=lambda x: dct_stat[x]['time_sum'],
-                  reverse=True)[:int(conf['REPORT_SIZE'])]
+        if 'sample' in stat:
+            dct_stat[url]['time_perc_ci'] = round_ci(intervals[2])
+        dct_stat[url]['time_avg'] = round(time_avg, 3)
+        dct_stat[url]['time_max'] = time_max
+        dct_stat[url]['time_med'] = round(time_med, 3)
+        for perc, value in zip(percentiles, time_percs):
+            dct_stat[url][percentile_name(perc)] = round(value, 3)
+        dct_stat[url][key] = url
+    with metrics.stage('sort'):
+        return sorted(dct_stat.keys(),
+                      key=lambda x: dct_stat[x]['time_sum'],
+                      reverse=True)[:get_top_size(conf, size)]
 
 
+def write_report(conf, report_name, dct_stat, processed, total_time, dims=None, metrics=None):
+    """
+    Calculate statistic data, render report and copy its script to REPORT_DIR.
+    Report of each other dimension is written next to url report as report-DATE.<dimension>.html
+    Return rows of report, rows of all urls if they are saved to HISTORY_DB
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    size = len(dct_stat) if get_option(conf, 'HISTORY_DB') else None
+    with metrics.stage('stats'):
+        top_urls = calc_stat_top_urls(conf, dct_stat, processed, total_time, size=size,
+                                      metrics=metrics)
+        top_dims = {name: calc_stat_top_urls(conf, stats, processed, total_time, name,
+                                             metrics=metrics)
+                    for name, stats in (dims or {}).items()}
+    rows = [dct_stat[url] for url in top_urls]
+    with metrics.stage('render'):
+        make_report(report_name, rows[:int(conf['REPORT_SIZE'])])
+        for name, top_keys in top_dims.items():
+            make_report(f'{os.path.splitext(report_name)[0]}.{name}.html',
+                        [dims[name][key] for key in top_keys], name)
+        if not os.path.isfile(os.path.join(conf['REPORT_DIR'], 'jquery.tablesorter.min.js')):
+            copyfile('jquery.tablesorter.min.js',
+                     os.path.join(conf['REPORT_DIR'], 'jquery.tablesorter.min.js'))
+    return rows
+
+def open_history(db_path):
+    """
+    Connect to history database creating its tables if needed
+    """
+    connection = sqlite3.connect(db_path)
+    connection.executescript(HISTORY_SCHEMA)
+    return connection
+
+def save_history(conf, date, rows, processed, total_time, metrics=None):
+    """
+    Replace report rows of log date in history database (HISTORY_DB) in one transaction
+    """
+    if not get_option(conf, 'HISTORY_DB'):
+        return
+    if is_sampling(conf):
+        logging.info(msg='Sampled report is not saved to history')
+        return
+    if metrics is None:
+        metrics = StageMetrics()
+    with metrics.stage('history'):
+        connection = open_history(get_option(conf, 'HISTORY_DB'))
+        try:
+            with connection:
+                connection.execute('DELETE FROM url_stat WHERE date = ?', (date,))
+                connection.executemany(
+                    f'INSERT INTO url_stat (date, url, {", ".join(HISTORY_FIELDS)}) '
+                    f'VALUES ({", ".join("?"*(len(HISTORY_FIELDS)+2))})',
+                    ((date, row['url'], *(row[field] for field in HISTORY_FIELDS))
+                     for row in rows))
+                connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                                   (date, processed, total_time,
+                                    datetime.datetime.now().isoformat(timespec='seconds')))
+        finally:
+            connection.close()
+    logging.info(msg=f"{len(rows)} rows of {date} saved to history "
+                     f"{get_option(conf, 'HISTORY_DB')}")
+
+def get_report_name(conf, date):
+    """
+    Return path of report for log date, sampled report is saved as report-DATE.sample.html
+    """
+    if is_sampling(conf):
+        return os.path.join(conf['REPORT_DIR'], f'report-{date}.sample.html')
+    return os.path.join(conf['REPORT_DIR'], f'report-{date}.html')
+
+def process_new_log(conf, log):
+    """
+    Build report for log found by daemon unless it already exists
+    """
+    report_name = get_report_name(conf, log.date)
+    if (not conf['FORCE']) and os.path.isfile(report_name):
+        logging.info(msg=f'Log {log.name} already processed. See report here {report_name}')
+        return
+    metrics = StageMetrics()
+    start_time = time.time()
+    with metrics.stage('process'):
+        dct_stat, processed, total_time, dims = process_logfile(conf, log, metrics)
+    rows = write_report(conf, report_name, dct_stat, processed, total_time, dims, metrics)
+    save_history(conf, log.date, rows, processed, total_time, metrics)
+    metrics.log()
+    logging.info(msg=f'Report {report_name} created in {time.time()-start_time} s')
+
+def new_daemon_state(conf):
+    """
+    Return initial state of daemon polls. Logs existing at start are not processed
+    except the latest one like in cron run
+    """
+    latest_log = get_latest_log(conf['LOG_DIR'])
+    seen = {log.name for log in find_logs(conf['LOG_DIR'])} - {getattr(latest_log, 'name', '')}
+    return {'seen': seen, 'pending': {}, 'failures': {}, 'dir_mtime': None}
+
+def poll_logs(conf, state, stop):
+    """
+    One poll of daemon. Directory is listed only when its mtime changes or some logs
+    are pending, log is processed when its size is the same as on the previous poll.
+    Log failed to process stays pending and is retried on the next polls,
+    up to DAEMON_ATTEMPTS times. Stop after current log if stop is set
+    """
+    seen, pending, failures = state['seen'], state['pending'], state['failures']
+    mtime = os.stat(conf['LOG_DIR']).st_mtime_ns
+    if mtime == state['dir_mtime'] and not pending:
+        return
+    state['dir_mtime'] = mtime
+    for log in sorted(find_logs(conf['LOG_DIR']), key=lambda log: log.date):
+        if log.name in seen:
+            continue
+        size = os.path.getsize(os.path.join(conf['LOG_DIR'], log.name))
+        if pending.get(log.name) != size:
+            pending[log.name] = size
+            continue
+        try:
+            process_new_log(conf, log)
+        except Exception:
+            failures[log.name] = failures.get(log.name, 0) + 1
+            logging.exception(msg=f'Processing of {log.name} failed, '
+                                  f'attempt {failures[log.name]} of {DAEMON_ATTEMPTS}')
+            if failures[log.name] < DAEMON_ATTEMPTS:
+                continue
+        del pending[log.name]
+        failures.pop(log.name, None)
+        seen.add(log.name)
+        if stop.is_set():
+            break
+    for name in [name for name in pending if name not in seen
+                 and not os.path.isfile(os.path.join(conf['LOG_DIR'], name))]:
+        del pending[name]
+        failures.pop(name, None)
+
+def run_daemon(conf):
+    """
+    Stay resident and build report for each new log as soon as it appears in LOG_DIR.
+    Logs are taken by poll_logs every POLL_INTERVAL seconds.
+    Stop on SIGTERM or SIGINT after current log is processed
+    """
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        logging.info(msg=f'Signal {signum} received, stopping')
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    interval = float(get_option(conf, 'POLL_INTERVAL'))
+    logging.info(msg=f"Watching {conf['LOG_DIR']} every {interval} s")
+    state = new_daemon_state(conf)
+    while not stop.is_set():
+        try:
+            poll_logs(conf, state, stop)
+        except Exception as error:
+            logging.exception(error)
+        stop.wait(interval)
+    logging.info(msg='Daemon stopped')
+
 def main(conf):
     """
     Main function
     """
     if not configure_logging(conf):
         exit(1)
+    metrics = StageMetrics()
+    profiler = cProfile.Profile() if get_flag(conf, 'PROFILE') else None
     try:
         start_time = time.time()
+        if profiler is not None:
+            profiler.enable()
         if not os.path.isdir(conf['LOG_DIR']):
             logging.info(msg=f"Log directory doesn't exist {conf['LOG_DIR']}")
             exit(1)
@@ -176,22 +2480,55 @@ def main(conf):
             except OSError:
                 logging.info(msg=f"Can not create directory {conf['REPORT_DIR']}")
                 exit(1)
-        latest_log = get_latest_log(conf['LOG_DIR'])
-        if latest_log is None:
-            logging.info(msg=f"Not found any log file in directory {conf['LOG_DIR']}")
-            exit(1)
+        if get_option(conf, 'BACKEND') == 'numpy' and get_backend(conf) != 'numpy':
+            logging.warning(msg='numpy backend needs numpy and exact aggregation, '
+                                'using python backend')
+        if get_flag(conf, 'GZIP_INDEX') and libz is None:
+            logging.warning(msg='gzip index needs libz, reading gzip logs sequentially')
+        if get_flag(conf, 'DAEMON'):
+            run_daemon(conf)
+            return
+        if is_batch(conf):
+            with metrics.stage('find_log'):
+                logs = get_batch_logs(conf)
+            if not logs:
+                logging.info(msg=f"Not found any log file for batch in directory {conf['LOG_DIR']}")
+                exit(1)
+            report_name = os.path.join(conf['REPORT_DIR'],
+                                       f'report-{logs[0].date}-{logs[-1].date}.html')
+            if (not conf['FORCE']) and os.path.isfile(report_name):
+                logging.info(msg=f'Logs already processed. See report here {report_name}')
+                exit(1)
+            with metrics.stage('process'):
+                dct_stat, processed, total_time, dims = process_batch(conf, logs, metrics)
+        else:
+            with metrics.stage('find_log'):
+                latest_log = get_latest_log(conf['LOG_DIR'])
+            if latest_log is None:
+                logging.info(msg=f"Not found any log file in directory {conf['LOG_DIR']}")
+                exit(1)
 
-        report_name = os.path.join(conf['REPORT_DIR'], f'report-{latest_log.date}.html')
-        if (not conf['FORCE']) and os.path.isfile(report_name):
-            logging.info(msg=f'Latest log already processed. See report here {report_name}')
-            exit(1)
+            report_name = get_report_name(conf, latest_log.date)
+            if (not conf['FORCE']) and (not get_flag(conf, 'INCREMENTAL')) \
+                    and os.path.isfile(report_name):
+                logging.info(msg=f'Latest log already processed. See report here {report_name}')
+                exit(1)
 
-        dct_stat, processed, total_time = process_logfile(conf, latest_log)
-        top_urls = calc_stat_top_urls(conf, dct_stat, processed, total_time)
-        make_report(report_name, [dct_stat[url] for url in top_urls])
-        if not os.path.isfile(os.path.join(conf['REPORT_DIR'], 'jquery.tablesorter.min.js')):
-            copyfile('jquery.tablesorter.min.js',
-                     os.path.join(conf['REPORT_DIR'], 'jquery.tablesorter.min.js'))
+            if get_flag(conf, 'COMPARE_READERS') and latest_log.ext == '.gz':
+                compare_gzip_readers(conf, os.path.join(conf['LOG_DIR'], latest_log.name))
+            with metrics.stage('process'):
+                dct_stat, processed, total_time, dims = process_logfile(conf, latest_log, metrics)
+        rows = write_report(conf, report_name, dct_stat, processed, total_time, dims, metrics)
+        if not is_batch(conf):
+            save_history(conf, latest_log.date, rows, processed, total_time, metrics)
+        if profiler is not None:
+            profiler.disable()
+            profile_name = os.path.splitext(report_name)[0] + '.prof'
+            profiler.dump_stats(profile_name)
+            logging.info(msg=f'Profile saved to {profile_name}')
+        metrics.log()
+        if get_option(conf, 'METRICS_FILE'):
+            metrics.save(get_option(conf, 'METRICS_FILE'))
         logging.info(msg='Finishing log_analyzer')
         logging.info(msg=f"Total time {time.time()-start_time}")
     except KeyboardInterrupt:
@@ -211,6 +2548,46 @@ def get_config(cmd_line_args):
                        (line.split('=') for line in open(cmd_line_args.config))}
         config.update(config_file)
     config['FORCE'] = cmd_line_args.force
+    if cmd_line_args.incremental:
+        config['INCREMENTAL'] = True
+    if cmd_line_args.workers:
+        config['WORKERS'] = cmd_line_args.workers
+    if cmd_line_args.gzip_pipeline:
+        config['GZIP_PIPELINE'] = True
+    if cmd_line_args.compare_readers:
+        config['COMPARE_READERS'] = True
+    if cmd_line_args.heavy_hitters:
+        config['HEAVY_HITTERS'] = cmd_line_args.heavy_hitters
+    if cmd_line_args.metrics:
+        config['METRICS_FILE'] = cmd_line_args.metrics
+    if cmd_line_args.profile:
+        config['PROFILE'] = True
+    if cmd_line_args.cache_dir:
+        config['CACHE_DIR'] = cmd_line_args.cache_dir
+    if cmd_line_args.daemon:
+        config['DAEMON'] = True
+    if cmd_line_args.spill_entries:
+        config['SPILL_ENTRIES'] = cmd_line_args.spill_entries
+    if cmd_line_args.spill_rss:
+        config['SPILL_RSS_MB'] = cmd_line_args.spill_rss
+    if cmd_line_args.history_db:
+        config['HISTORY_DB'] = cmd_line_args.history_db
+    if cmd_line_args.sample:
+        config['SAMPLE'] = cmd_line_args.sample
+    if cmd_line_args.gzip_index:
+        config['GZIP_INDEX'] = True
+    if cmd_line_args.mmap:
+        config['MMAP'] = True
+    if cmd_line_args.bytes:
+        config['READ_MODE'] = 'bytes'
+    if cmd_line_args.group_by:
+        config['GROUP_BY'] = cmd_line_args.group_by
+    if cmd_line_args.days:
+        config['BATCH_DAYS'] = cmd_line_args.days
+    if cmd_line_args.date_from:
+        config['DATE_FROM'] = cmd_line_args.date_from
+    if cmd_line_args.date_to:
+        config['DATE_TO'] = cmd_line_args.date_to
     return config
 
 
@@ -223,4 +2600,76 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--force',
                         action='store_true',
                         help='Force overwrite existing report')
+    parser.add_argument('-i', '--incremental',
+                        action='store_true',
+                        help='Parse only lines appended since the last run and update report')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes for parsing uncompressed log')
+    parser.add_argument('-g', '--gzip-pipeline',
+                        action='store_true',
+                        help='Inflate gzip log in separate thread pipelined with parsing')
+    parser.add_argument('--compare-readers',
+                        action='store_true',
+                        help='Log throughput of plain and pipelined readers for gzip log')
+    parser.add_argument('-t', '--heavy-hitters',
+                        type=int,
+                        default=None,
+                        help='Approximate top urls keeping at most N url counters in memory')
+    parser.add_argument('-m', '--metrics',
+                        type=str,
+                        default=None,
+                        help='Save per-stage timing and memory metrics to json file')
+    parser.add_argument('-p', '--profile',
+                        action='store_true',
+                        help='Profile run with cProfile and save stats next to the report')
+    parser.add_argument('--cache-dir',
+                        type=str,
+                        default=None,
+                        help='Directory for cached log aggregates')
+    parser.add_argument('-D', '--daemon',
+                        action='store_true',
+                        help='Stay resident and build reports for new logs in LOG_DIR')
+    parser.add_argument('-b', '--bytes',
+                        action='store_true',
+                        help='Read and parse log as bytes decoding only urls')
+    parser.add_argument('--spill-entries',
+                        type=int,
+                        default=None,
+                        help='Spill url aggregates to disk when there are N of them in memory')
+    parser.add_argument('--spill-rss',
+                        type=float,
+                        default=None,
+                        help='Spill url aggregates to disk when resident memory reaches MB')
+    parser.add_argument('-H', '--history-db',
+                        type=str,
+                        default=None,
+                        help='Save report rows to SQLite history database')
+    parser.add_argument('-s', '--sample',
+                        type=float,
+                        default=None,
+                        help='Quick estimate parsing only given fraction of log, e.g. 0.1')
+    parser.add_argument('-x', '--gzip-index',
+                        action='store_true',
+                        help='Build access point index of gzip log and parse it in parallel')
+    parser.add_argument('-M', '--mmap',
+                        action='store_true',
+                        help='Read uncompressed log from memory map as bytes')
+    parser.add_argument('-G', '--group-by',
+                        type=str,
+                        default=None,
+                        help='Comma separated dimensions aggregated in one pass: url,status,hour,...')
+    parser.add_argument('-d', '--days',
+                        type=int,
+                        default=None,
+                        help='Batch mode: merged report for logs of last N days')
+    parser.add_argument('--date-from',
+                        type=str,
+                        default=None,
+                        help='Batch mode: merged report for logs since date YYYY.MM.DD')
+    parser.add_argument('--date-to',
+                        type=str,
+                        default=None,
+                        help='Batch mode: merged report for logs until date YYYY.MM.DD')
     main(get_config(parser.parse_args()))
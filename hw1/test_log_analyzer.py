@@ -1,6 +1,15 @@
 import unittest
+import random
 import log_analyzer
+import benchmark
+import history
 import os
+import tempfile
+import gzip
+import json
+import shutil
+import threading
+from unittest import mock
 
 
 class SimplisticTest(unittest.TestCase):
@@ -27,5 +36,542 @@ class SimplisticTest(unittest.TestCase):
             result = ''
         self.assertTrue(target == result)
 
+    def test_parallel(self):
+        log_path = './test/log/nginx-access-ui.log-20180630'
+        serial = log_analyzer.parse_lines({}, log_analyzer.xreadlines(log_path))
+        for workers in (2, 3):
+            parallel = log_analyzer.process_parallel({}, log_path, workers)
+            self.assertEqual(serial[:3], parallel[:3])
+            # summation order differs between chunks, only the last digits may differ
+            self.assertAlmostEqual(serial[3], parallel[3])
+
+    def test_sketch(self):
+        log_path = './test/log/nginx-access-ui.log-20180630'
+        conf = {'REPORT_SIZE': 100}
+        exact = log_analyzer.parse_lines(conf, log_analyzer.xreadlines(log_path))
+        sketch = log_analyzer.process_parallel({'AGGREGATION': 'sketch'}, log_path, 2)
+        exact_rows = {url: exact[0][url] for url in log_analyzer.calc_stat_top_urls(conf, exact[0], *exact[2:4])}
+        sketch_rows = {url: sketch[0][url] for url in log_analyzer.calc_stat_top_urls(conf, sketch[0], *sketch[2:4])}
+        self.assertEqual(exact_rows.keys(), sketch_rows.keys())
+        for url, row in exact_rows.items():
+            self.assertEqual(row['count'], sketch_rows[url]['count'])
+            self.assertEqual(row['time_max'], sketch_rows[url]['time_max'])
+            self.assertLessEqual(abs(row['time_med'] - sketch_rows[url]['time_med']),
+                                 0.01*row['time_med'] + 0.001)
+        for values in ([0.1, 10.0], [0.0, 0.5, 2.0, 7.0], [3.0]):
+            sketch = log_analyzer.QuantileSketch()
+            for value in values:
+                sketch.add(value)
+            median = log_analyzer.median(values)
+            self.assertLessEqual(abs(sketch.quantile(0.5) - median), 0.01*median)
+
+    def test_fast_parser(self):
+        conf = {'REPORT_SIZE': 100}
+        for name in os.listdir('./test/log'):
+            log_path = os.path.join('./test/log', name)
+            reports = []
+            for parser in ('regex', 'fast'):
+                conf['PARSER'] = parser
+                dct_stat, _, processed, total_time, _ = log_analyzer.parse_lines(
+                    conf, log_analyzer.xreadlines(log_path))
+                top_urls = log_analyzer.calc_stat_top_urls(conf, dct_stat, processed, total_time)
+                reports.append([dct_stat[url] for url in top_urls])
+            self.assertEqual(reports[0], reports[1])
+            for line in log_analyzer.xreadlines(log_path):
+                self.assertEqual(log_analyzer.parse_line(line, log_analyzer.LINE_FIELDS, False),
+                                 log_analyzer.parse_line(line, log_analyzer.LINE_FIELDS, True))
+        # lines broken before or after the request are rejected by both parsers
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 '
+                'HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393" "dc7161be3" '
+                '0.390')
+        self.assertIsNotNone(log_analyzer.parse_line_fast(line))
+        for broken in (line.replace('1.196.116.32', 'host'), line.replace('[29/Jun', '29/Jun'),
+                       line.replace(' -  - ', ' - - '), line.replace(' 200 927 ', ' 200 ')):
+            self.assertIsNone(log_analyzer.parse_line_fast(broken))
+            for fast in (False, True):
+                self.assertIsNone(log_analyzer.parse_line(broken, fast=fast))
+                self.assertIsNone(log_analyzer.parse_line_bytes(broken.encode('utf-8'),
+                                                                log_analyzer.REQUIRED_FIELDS,
+                                                                fast, {}))
+
+    def test_incremental(self):
+        with open('./test/log/nginx-access-ui.log-20180630', 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = {'REPORT_DIR': tmp_dir}
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180630')
+            checkpoint_path = os.path.join(tmp_dir, 'checkpoint')
+            with open(log_path, 'w', encoding='utf-8') as f:
+                f.writelines(lines[:4])
+                f.write(lines[4][:20])  # line which is still being written
+            part = log_analyzer.process_incremental(conf, log_path, checkpoint_path)
+            self.assertEqual(part[1], 4)
+            with open(log_path, 'a', encoding='utf-8') as f:
+                f.write(lines[4][20:])
+                f.writelines(lines[5:])
+            result = log_analyzer.process_incremental(conf, log_path, checkpoint_path)
+            full = log_analyzer.parse_lines(conf, iter(lines))
+            self.assertEqual(full[:3], result[:3])
+            self.assertAlmostEqual(full[3], result[3])
+            # truncated log is parsed from the start
+            with open(log_path, 'w', encoding='utf-8') as f:
+                f.writelines(lines[:2])
+            result = log_analyzer.process_incremental(conf, log_path, checkpoint_path)
+            self.assertEqual(log_analyzer.parse_lines(conf, iter(lines[:2]))[:3], result[:3])
+            # unreadable checkpoint (e.g. json one of older version) is ignored
+            with open(checkpoint_path, 'w', encoding='utf-8') as f:
+                f.write('{"offset": 0}')
+            result = log_analyzer.process_incremental(conf, log_path, checkpoint_path)
+            self.assertEqual(log_analyzer.parse_lines(conf, iter(lines[:2]))[:3], result[:3])
+            for aggregation in ('exact', 'sketch'):
+                conf['AGGREGATION'] = aggregation
+                log_analyzer.process_incremental(conf, log_path, checkpoint_path)
+                checkpoint = log_analyzer.load_checkpoint(conf, log_path, checkpoint_path,
+                                                          os.stat(log_path))
+                self.assertEqual(
+                    [stat.get('times') or stat['sketch'].quantile(0.5)
+                     for stat in log_analyzer.parse_lines(conf, iter(lines[:2]))[0].values()],
+                    [stat.get('times') or stat['sketch'].quantile(0.5)
+                     for stat in checkpoint['stat'].values()])
+
+    def test_batch(self):
+        conf = {'LOG_DIR': './test/log', 'WORKERS': 2, 'DATE_FROM': '2017.06.30'}
+        logs = log_analyzer.get_batch_logs(conf)
+        self.assertEqual([log.date for log in logs], ['2017.06.30', '2018.06.30'])
+        self.assertEqual(log_analyzer.get_batch_logs(dict(conf, BATCH_DAYS=1)), logs[1:])
+        for date in ('2017-06-30', '2017.13.01', '20170630'):
+            with self.assertRaises(ValueError):
+                log_analyzer.get_batch_logs(dict(conf, DATE_TO=date))
+        lines = []
+        for log in logs:
+            lines.extend(log_analyzer.xreadlines(os.path.join(conf['LOG_DIR'], log.name)))
+        dct_stat, _, processed, total_time, _ = log_analyzer.parse_lines(conf, lines)
+        for workers in (2, 0):
+            batch = log_analyzer.process_batch(dict(conf, WORKERS=workers), logs)
+            self.assertEqual((dct_stat, processed), batch[:2])
+            self.assertAlmostEqual(total_time, batch[2])
+
+    def test_gzip_pipeline(self):
+        with open('./test/log/nginx-access-ui.log-20180630', 'rb') as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180630.gz')
+            with open(log_path, 'wb') as f:
+                # multi-member gzip file
+                f.write(gzip.compress(data[:1000]) + gzip.compress(data[1000:]))
+            self.assertEqual([line.rstrip('\n') for line in log_analyzer.xreadlines(log_path)],
+                             list(log_analyzer.xreadlines_pipelined(log_path)))
+
+    def test_gzip_truncated(self):
+        with open('./test/log/nginx-access-ui.log-20180630', 'rb') as f:
+            data = gzip.compress(f.read())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180630.gz')
+            with open(log_path, 'wb') as f:
+                f.write(data[:len(data)//2])
+            for conf in ({}, {'GZIP_PIPELINE': True}, {'WORKERS': 2}):
+                with self.assertRaises(EOFError):
+                    log_analyzer.parse_logfile(conf, log_path)
+
+    def test_normalize_urls(self):
+        normalize = log_analyzer.UrlNormalizer(keep_params=['date_type'])
+        self.assertEqual(normalize('/api/v2/group/7786679/statistic/sites/?date_type=day&'
+                                   'date_from=2017-06-28 HTTP/1.1'),
+                         '/api/v2/group/{id}/statistic/sites/?date_type=day HTTP/1.1')
+        self.assertEqual(normalize('/api/1/photogenic_banners/list/?server_name=WIN7RB4'),
+                         '/api/{id}/photogenic_banners/list/')
+        conf = {'NORMALIZE_URLS': '1'}
+        dct_stat, _, processed, _, _ = log_analyzer.parse_lines(
+            conf, log_analyzer.xreadlines('./test/log/nginx-access-ui.log-20180630'))
+        self.assertEqual(len(dct_stat['/api/v2/banner/{id} HTTP/1.1']['times']), 3)
+        self.assertEqual(sum(len(stat['times']) for stat in dct_stat.values()), processed)
+
+    def test_heavy_hitters(self):
+        log_path = './test/log/nginx-access-ui.log-20180630'
+        conf = {'REPORT_SIZE': 100, 'NORMALIZE_URLS': True}
+        exact = log_analyzer.parse_lines(conf, log_analyzer.xreadlines(log_path))
+        true_sum = {url: sum(stat['times']) for url, stat in exact[0].items()}
+        conf['HEAVY_HITTERS'] = 3
+        for dct_stat, _, processed, total_time, _ in (
+                log_analyzer.parse_lines(conf, log_analyzer.xreadlines(log_path)),
+                log_analyzer.process_parallel(conf, log_path, 2)):
+            self.assertLessEqual(len(dct_stat), 3)
+            # counters don't keep request times even in exact aggregation mode
+            self.assertFalse(any('times' in stat for stat in dct_stat.values()))
+            top_urls = log_analyzer.calc_stat_top_urls(conf, dct_stat, processed, total_time)
+            for url in top_urls:
+                row = dct_stat[url]
+                self.assertLessEqual(row['time_sum'] - row['time_sum_error'] - 0.001, true_sum[url])
+                self.assertGreaterEqual(row['time_sum'] + 0.001, true_sum[url])
+            for url, time_sum in true_sum.items():
+                if time_sum > total_time/3:
+                    self.assertIn(url, top_urls)
+
+    @unittest.skipIf(log_analyzer.np is None, 'numpy is not installed')
+    def test_numpy_backend(self):
+        conf = {'REPORT_SIZE': 100, 'PERCENTILES': '90,95,99', 'NORMALIZE_URLS': True}
+        for name in os.listdir('./test/log'):
+            log_path = os.path.join('./test/log', name)
+            reports = []
+            for backend, workers in (('python', 1), ('numpy', 1), ('numpy', 2)):
+                conf.update(BACKEND=backend)
+                dct_stat, _, processed, total_time, _ = log_analyzer.parse_logfile(
+                    dict(conf, WORKERS=workers), log_path)
+                top_urls = log_analyzer.calc_stat_top_urls(conf, dct_stat, processed, total_time)
+                reports.append([dct_stat[url] for url in top_urls])
+            self.assertEqual(reports[0], reports[1])
+            self.assertEqual(reports[0], reports[2])
+        # no parsed lines
+        for lines in ([], ['garbage\n']):
+            for backend in ('python', 'numpy'):
+                dct_stat, total, processed, total_time, _ = log_analyzer.parse_lines(
+                    dict(conf, BACKEND=backend), iter(lines))
+                self.assertEqual((total, processed), (len(lines), 0))
+                self.assertEqual(log_analyzer.calc_stat_top_urls(
+                    dict(conf, BACKEND=backend), dct_stat, processed, total_time), [])
+
+    def test_benchmark_log(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.gz')
+            benchmark.generate_log(log_path, 1000, 50)
+            dct_stat, total, processed, _, _ = log_analyzer.parse_lines(
+                {'PARSER': 'regex'}, log_analyzer.xreadlines(log_path))
+            self.assertEqual((total, processed, len(dct_stat)), (1000, 1000, 50))
+        # memory of stage is measured after earlier stages raised peak RSS
+        results = {}
+        benchmark.measure(results, 'earlier', 1, lambda: bytearray(80*1024*1024))
+        hold = benchmark.measure(results, 'hold', 1, lambda: bytearray(80*1024*1024))
+        benchmark.measure(results, 'small', 1, lambda: None)
+        self.assertGreater(results['hold']['rss_delta_mb'], 60)
+        self.assertLess(results['small']['rss_delta_mb'], 10)
+        del hold
+
+    def test_cache(self):
+        log_path = './test/log/nginx-access-ui.log-20180630'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = {'CACHE_DIR': tmp_dir}
+            parsed = log_analyzer.parse_logfile_cached(conf, log_path)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            self.assertEqual(parsed, log_analyzer.parse_logfile_cached(conf, log_path))
+            cache_path = os.path.join(tmp_dir, os.listdir(tmp_dir)[0])
+            os.utime(cache_path, (0, 0))
+            # other aggregation options give other cache file, the oldest one is evicted
+            log_analyzer.parse_logfile_cached(dict(conf, NORMALIZE_URLS=True, CACHE_SIZE_MB=0.001),
+                                              log_path)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            self.assertFalse(os.path.isfile(cache_path))
+            # parser options and contents of url rules file are part of cache key
+            rules_path = os.path.join(tmp_dir, 'rules.json')
+            paths = set()
+            for rules, options in (('[]', {}), ('[]', {'PARSER': 'regex'}),
+                                   ('[]', {'READ_MODE': 'bytes'}), ('[]', {'FIELDS': 'status'}),
+                                   ('[["\\\\d+", "{id}"]]', {})):
+                with open(rules_path, 'w', encoding='utf-8') as frules:
+                    frules.write(rules)
+                paths.add(log_analyzer.get_cache_path(
+                    dict(conf, NORMALIZE_URLS=True, URL_RULES=rules_path, **options), log_path))
+            self.assertEqual(len(paths), 5)
+
+    def test_group_by(self):
+        log_path = './test/log/nginx-access-ui.log-20180630'
+        conf = {'GROUP_BY': 'url,status,hour', 'REPORT_SIZE': 100}
+        dct_stat, total, processed, total_time, dims = log_analyzer.parse_lines(
+            conf, log_analyzer.xreadlines(log_path))
+        self.assertEqual(dct_stat, log_analyzer.parse_lines({}, log_analyzer.xreadlines(log_path))[0])
+        self.assertEqual(sorted(dims), ['hour', 'status'])
+        for stats in dims.values():
+            self.assertEqual(sum(len(stat['times']) for stat in stats.values()), processed)
+        self.assertEqual(dims, log_analyzer.process_parallel(conf, log_path, 2)[4])
+        top_status = log_analyzer.calc_stat_top_urls(conf, dims['status'], processed, total_time,
+                                                     'status')
+        row = dims['status'][top_status[0]]
+        self.assertEqual(row['status'], top_status[0])
+        self.assertIn('bytes_sum', row)
+        with self.assertRaises(ValueError):
+            log_analyzer.get_dimensions({'GROUP_BY': 'url,unknown'})
+        # aggregates are consumed by calc_stat_top_urls, report is built from fresh ones
+        dct_stat, total, processed, total_time, dims = log_analyzer.parse_lines(
+            conf, log_analyzer.xreadlines(log_path))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_name = os.path.join(tmp_dir, 'report-2018.06.30.html')
+            log_analyzer.write_report(dict(conf, REPORT_DIR=tmp_dir), report_name, dct_stat,
+                                      processed, total_time, dims)
+            for name in ('url', 'status', 'hour'):
+                path = report_name if name == 'url' else f'{report_name[:-5]}.{name}.html'
+                with open(path, encoding='utf-8') as f:
+                    self.assertIn(f'var keyColumn = "{name}";', f.read())
+
+    def test_bytes_mode(self):
+        for name in os.listdir('./test/log'):
+            log_path = os.path.join('./test/log', name)
+            for parser in ('regex', 'fast'):
+                conf = {'PARSER': parser}
+                text = log_analyzer.parse_logfile(conf, log_path)
+                conf['READ_MODE'] = 'bytes'
+                self.assertEqual(text, log_analyzer.parse_logfile(conf, log_path))
+                self.assertEqual(text, log_analyzer.parse_logfile(dict(conf, GZIP_PIPELINE=True),
+                                                                  log_path))
+                self.assertEqual(text[:3], log_analyzer.parse_logfile(dict(conf, WORKERS=2),
+                                                                      log_path)[:3])
+        with open('./test/log/nginx-access-ui.log-20180630', 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+        # invalid UTF-8 in url of the first line
+        lines[0] = lines[0].replace(b'/api/', b'/api\xff/', 1)
+        for conf in ({'READ_MODE': 'bytes'}, {'READ_MODE': 'bytes', 'GROUP_BY': 'url,status'}):
+            dct_stat, total, processed, _, _ = log_analyzer.parse_lines(conf, iter(lines))
+            self.assertEqual((total, processed), (len(lines), len(lines) - 1))
+        # decoded urls memo is bounded
+        urls = {str(i).encode(): str(i) for i in range(log_analyzer.URL_CACHE_SIZE)}
+        fields = log_analyzer.get_fields({})
+        line_dict = log_analyzer.parse_line_bytes(lines[1].rstrip(b'\n'), fields, True, urls)
+        self.assertEqual(list(urls.values()), [line_dict['request']])
+
+    def test_mmap(self):
+        log_path = './test/log/nginx-access-ui.log-20180630'
+        conf = {'MMAP': True}
+        text = log_analyzer.parse_logfile({}, log_path)
+        self.assertEqual(text, log_analyzer.parse_logfile(conf, log_path))
+        self.assertEqual(text[:3], log_analyzer.parse_logfile(dict(conf, WORKERS=2), log_path)[:3])
+        for start, end in log_analyzer.split_logfile(log_path, 3):
+            self.assertEqual([line.rstrip(b'\n') for line in
+                              log_analyzer.read_chunk(log_path, start, end, True)],
+                             list(log_analyzer.xreadlines_mmap(log_path, start, end)))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20180630')
+            open(tmp_path, 'wb').close()
+            self.assertEqual(list(log_analyzer.xreadlines_mmap(tmp_path)), [])
+            with open(tmp_path, 'wb') as f:
+                f.write(b'first\nlast')
+            self.assertEqual(list(log_analyzer.xreadlines_mmap(tmp_path)), [b'first', b'last'])
+
+    @unittest.skipIf(log_analyzer.libz is None, 'libz is not found')
+    def test_gzip_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.gz')
+            benchmark.generate_log(log_path, 20000, 500)
+            with gzip.open(log_path, 'rb') as f:
+                data = f.read()
+            for multi_member in (False, True):
+                if multi_member:
+                    with open(log_path, 'wb') as f:
+                        f.write(gzip.compress(data[:1000001]) + gzip.compress(data[1000001:]))
+                plain = log_analyzer.parse_logfile({}, log_path)
+                conf = {'GZIP_INDEX': True, 'GZIP_INDEX_SPAN_MB': 0.1, 'WORKERS': 2}
+                # the first run builds index, the next ones parse log from access points
+                self.assertEqual(plain, log_analyzer.parse_logfile(conf, log_path))
+                self.assertTrue(os.path.isfile(log_path + 'idx'))
+                points = log_analyzer.load_gzip_index(log_path)
+                self.assertGreater(len(points), 10)
+                self.assertEqual(plain[:3], log_analyzer.parse_logfile(conf, log_path)[:3])
+                for point, next_point in zip(points, points[1:] + [(None,)]):
+                    lines = list(log_analyzer.read_gzip_chunk(log_path, point, next_point[0],
+                                                              True))
+                    # the first line starting at access point or after it
+                    first = data.find(b'\n', point[0] - 1) + 1 if point[0] else 0
+                    self.assertEqual(lines[0], data[first:data.find(b'\n', first)])
+            # truncated log is not parsed partially and is not indexed
+            with open(log_path, 'rb') as f:
+                compressed = f.read()
+            truncated_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170629.gz')
+            with open(truncated_path, 'wb') as f:
+                f.write(compressed[:len(compressed)//2])
+            with self.assertRaises(EOFError):
+                log_analyzer.parse_logfile(conf, truncated_path)
+            self.assertFalse(os.path.isfile(truncated_path + 'idx'))
+            with self.assertRaises(EOFError):
+                list(log_analyzer.inflate_from_point(truncated_path, points[len(points)//4]))
+            # malformed index is ignored
+            with open(log_path + 'idx', 'rb') as f:
+                index = f.read()
+            for broken in (b'', index[:len(index)//2], index + b'x', b'\x80\x04}q\x00.'):
+                with open(log_path + 'idx', 'wb') as f:
+                    f.write(broken)
+                self.assertIsNone(log_analyzer.load_gzip_index(log_path))
+            self.assertEqual(plain, log_analyzer.parse_logfile(conf, log_path))
+
+    def test_sample(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ('nginx-access-ui.log-20170630', 'nginx-access-ui.log-20170630.gz'):
+                log_path = os.path.join(tmp_dir, name)
+                benchmark.generate_log(log_path, 20000, 100)
+                full = log_analyzer.parse_logfile({}, log_path)
+                true_sum = {url: sum(stat['times']) for url, stat in full[0].items()}
+                conf = {'REPORT_SIZE': 5, 'SAMPLE': 0.2}
+                dct_stat, total, processed, total_time, _ = log_analyzer.process_sample(
+                    conf, log_path, random.Random(0))
+                self.assertAlmostEqual(total/full[1], 1, delta=0.1)
+                self.assertAlmostEqual(total_time/full[3], 1, delta=0.1)
+                top_urls = log_analyzer.calc_stat_top_urls(conf, dct_stat, processed, total_time)
+                # 95% intervals miss sometimes, doubled ones practically never
+                for url in top_urls:
+                    row = dct_stat[url]
+                    self.assertLessEqual(abs(row['count'] - len(full[0][url]['times'])),
+                                         2*row['count_ci'])
+                    self.assertLessEqual(abs(row['time_sum'] - true_sum[url]),
+                                         2*row['time_sum_ci'])
+                    self.assertLessEqual(abs(row['time_perc'] - true_sum[url]/full[3]*100),
+                                         2*row['time_perc_ci'])
+        self.assertFalse(log_analyzer.is_sampling({'SAMPLE': 1}))
+
+    def test_history(self):
+        conf = {'REPORT_SIZE': 100}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf['HISTORY_DB'] = os.path.join(tmp_dir, 'history.db')
+            reports = {}
+            for log in log_analyzer.find_logs('./test/log'):
+                dct_stat, _, processed, total_time, _ = log_analyzer.parse_logfile(
+                    conf, os.path.join('./test/log', log.name))
+                top_urls = log_analyzer.calc_stat_top_urls(conf, dct_stat, processed, total_time)
+                reports[log.date] = [dct_stat[url] for url in top_urls]
+                log_analyzer.save_history(conf, log.date, reports[log.date], processed, total_time)
+            # the second run for the same date replaces its rows
+            log_analyzer.save_history(conf, '2018.06.30', reports['2018.06.30'], 0, 0)
+            connection = log_analyzer.open_history(conf['HISTORY_DB'])
+            row = reports['2018.06.30'][0]
+            self.assertEqual(history.query_series(connection, row['url'], 'time_med'),
+                             [(date, report_row['time_med']) for date, report in sorted(reports.items())
+                              for report_row in report if report_row['url'] == row['url']])
+            self.assertEqual(history.query_series(connection, row['url'], 'count', '2018.01.01'),
+                             [('2018.06.30', row['count'])])
+            top = history.query_top(connection, 3, date_from='2018.06.30')
+            self.assertEqual([url for url, *_ in top],
+                             [report_row['url'] for report_row in reports['2018.06.30'][:3]])
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM url_stat').fetchone()[0],
+                             sum(len(report) for report in reports.values()))
+            connection.close()
+            # url out of REPORT_SIZE top urls of a day is saved too
+            conf = {'REPORT_SIZE': 1, 'REPORT_DIR': tmp_dir,
+                    'HISTORY_DB': os.path.join(tmp_dir, 'top.db')}
+            line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {} HTTP/1.1" 200 927 '
+                    '"-" "-" "-" "-" "-" {}\n')
+            for date, (time_a, time_b) in {'2017.06.28': (1.0, 0.5), '2017.06.29': (0.5, 1.0),
+                                           '2017.06.30': (1.0, 0.5)}.items():
+                dct_stat, _, processed, total_time, _ = log_analyzer.parse_lines(
+                    conf, iter([line.format('/a', time_a), line.format('/b', time_b)]))
+                rows = log_analyzer.write_report(conf, os.path.join(tmp_dir, f'report-{date}.html'),
+                                                 dct_stat, processed, total_time)
+                log_analyzer.save_history(conf, date, rows, processed, total_time)
+            connection = log_analyzer.open_history(conf['HISTORY_DB'])
+            self.assertEqual(history.query_series(connection, '/b HTTP/1.1', 'time_sum'),
+                             [('2017.06.28', 0.5), ('2017.06.29', 1.0), ('2017.06.30', 0.5)])
+            self.assertEqual(history.query_top(connection, 1),
+                             [('/a HTTP/1.1', 3, 2.5, 1.0, 0.833, 3)])
+            connection.close()
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170630')
+            benchmark.generate_log(log_path, 5000, 3000)
+            # top 800 urls include urls with equal time_sum
+            for conf in ({'REPORT_SIZE': 800, 'SPILL_ENTRIES': 100, 'SPILL_PARTITIONS': 4},
+                         {'REPORT_SIZE': 5, 'SPILL_ENTRIES': 2, 'AGGREGATION': 'sketch'},
+                         {'REPORT_SIZE': 20, 'SPILL_RSS_MB': 0.001, 'SPILL_DIR': tmp_dir}):
+                reports = []
+                for parse in (log_analyzer.parse_logfile, log_analyzer.process_spilled):
+                    dct_stat, _, processed, total_time, _ = parse(conf, log_path)
+                    top_urls = log_analyzer.calc_stat_top_urls(conf, dct_stat, processed,
+                                                               total_time)
+                    reports.append([dct_stat[url] for url in top_urls])
+                self.assertEqual(reports[0], reports[1])
+                self.assertEqual(os.listdir(tmp_dir), ['nginx-access-ui.log-20170630'])
+            # memory limit hit turns into limit of the number of urls
+            spill = log_analyzer.Spill({'SPILL_RSS_MB': 0.001, 'SPILL_DIR': tmp_dir})
+            try:
+                self.assertFalse(spill.is_full({'a': 1, 'b': 2}, 1))
+                self.assertTrue(spill.is_full({'a': 1, 'b': 2}, log_analyzer.SPILL_CHECK_LINES))
+                self.assertFalse(spill.is_full({'a': 1}, 2*log_analyzer.SPILL_CHECK_LINES))
+                self.assertTrue(spill.is_full({'a': 1, 'b': 2}, 1))
+            finally:
+                spill.close()
+
+    def test_daemon_poll(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = dict(log_analyzer.CONFIG, LOG_DIR=os.path.join(tmp_dir, 'log'),
+                        REPORT_DIR=tmp_dir, FORCE=False)
+            os.mkdir(conf['LOG_DIR'])
+            shutil.copy('./test/log/nginx-access-ui.log-20170630', conf['LOG_DIR'])
+            state = log_analyzer.new_daemon_state(conf)
+            # the latest log at start is processed, after its size is stable for two polls
+            self.assertEqual(state['seen'], set())
+            stop = threading.Event()
+            log_analyzer.poll_logs(conf, state, stop)
+            self.assertEqual(list(state['pending']), ['nginx-access-ui.log-20170630'])
+            log_analyzer.poll_logs(conf, state, stop)
+            self.assertEqual(state['seen'], {'nginx-access-ui.log-20170630'})
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir, 'report-2017.06.30.html')))
+            # directory is not listed while its mtime is the same
+            new_log = os.path.join(conf['LOG_DIR'], 'nginx-access-ui.log-20180630')
+            dir_stat = os.stat(conf['LOG_DIR'])
+            shutil.copy('./test/log/nginx-access-ui.log-20180630', new_log)
+            os.utime(conf['LOG_DIR'], ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+            log_analyzer.poll_logs(conf, state, stop)
+            self.assertEqual(state['pending'], {})
+            # failed log is retried DAEMON_ATTEMPTS times
+            os.utime(conf['LOG_DIR'])
+            with mock.patch.object(log_analyzer, 'process_new_log',
+                                   side_effect=OSError('disk full')) as process:
+                for _ in range(log_analyzer.DAEMON_ATTEMPTS + 2):
+                    log_analyzer.poll_logs(conf, state, stop)
+            self.assertEqual(process.call_count, log_analyzer.DAEMON_ATTEMPTS)
+            self.assertIn('nginx-access-ui.log-20180630', state['seen'])
+            self.assertEqual((state['pending'], state['failures']), ({}, {}))
+            # stop is checked after each processed log
+            state = log_analyzer.new_daemon_state(conf)
+            state['seen'] = set()
+            stop.set()
+            with mock.patch.object(log_analyzer, 'process_new_log') as process:
+                log_analyzer.poll_logs(conf, state, stop)
+                log_analyzer.poll_logs(conf, state, stop)
+            self.assertEqual(process.call_count, 1)
+            self.assertEqual(state['seen'], {'nginx-access-ui.log-20170630'})
+            # sampled report doesn't take name of the full one
+            stop.clear()
+            conf['SAMPLE'] = 0.5
+            state = log_analyzer.new_daemon_state(conf)
+            state['seen'] = {'nginx-access-ui.log-20170630'}
+            log_analyzer.poll_logs(conf, state, stop)
+            log_analyzer.poll_logs(conf, state, stop)
+            self.assertTrue(os.path.isfile(os.path.join(tmp_dir,
+                                                        'report-2018.06.30.sample.html')))
+            self.assertFalse(os.path.isfile(os.path.join(tmp_dir, 'report-2018.06.30.html')))
+
+    def test_compare_readers_option(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark.generate_log(os.path.join(tmp_dir, 'nginx-access-ui.log-20170630.gz'),
+                                   100, 10)
+            # option from config file is a string like other flags
+            for value, calls in (('1', 1), ('0', 0), (log_analyzer.CONFIG['COMPARE_READERS'], 0)):
+                conf = dict(log_analyzer.CONFIG, LOG_DIR=tmp_dir, REPORT_DIR=tmp_dir, FORCE=True,
+                            COMPARE_READERS=value)
+                with mock.patch.object(log_analyzer, 'configure_logging', return_value=1), \
+                        mock.patch.object(log_analyzer, 'compare_gzip_readers') as compare:
+                    log_analyzer.main(conf)
+                self.assertEqual(compare.call_count, calls)
+
+    def test_metrics(self):
+        log_path = './test/log/nginx-access-ui.log-20180630'
+        metrics = log_analyzer.StageMetrics()
+        with metrics.stage('process'):
+            log_analyzer.parse_logfile({}, log_path, metrics=metrics)
+            with metrics.stage('hold'):
+                data = bytearray(64*1024*1024)
+        result = metrics.result()
+        self.assertEqual(set(result), {'process', 'read', 'parse', 'aggregate', 'hold'})
+        # memory change of stage includes its nested stages
+        self.assertGreater(result['hold']['rss_delta_mb'], 60)
+        self.assertGreater(result['process']['rss_delta_mb'], 60)
+        del data
+        # stages are collected only by metrics passed to the calls
+        log_analyzer.parse_logfile({}, log_path)
+        self.assertEqual(metrics.result(), result)
+        metrics = log_analyzer.StageMetrics()
+        log_analyzer.parse_logfile({'WORKERS': 2}, log_path, metrics=metrics)
+        self.assertFalse(set(log_analyzer.LINE_STAGES) & set(metrics.stages))
+        self.assertEqual(set(metrics.unavailable), set(log_analyzer.LINE_STAGES))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics.save(os.path.join(tmp_dir, 'metrics.json'))
+            with open(os.path.join(tmp_dir, 'metrics.json'), encoding='utf-8') as f:
+                self.assertIn('read', json.load(f)['unavailable'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -11,12 +11,18 @@ import datetime
 import logging
 import hashlib
 import uuid
+import threading
+import asyncio
+import io
+from http import HTTPStatus
 from optparse import OptionParser
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.client import parse_headers
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABCMeta, abstractmethod
 
-from scoring import get_score, get_interests
-from store import TarantoolStore
+from scoring import get_score, get_interests_many, get_interests_many_async
+from store import TarantoolStore, AsyncTarantoolStore
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -25,12 +31,14 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_TOO_LARGE = 413
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
 }
@@ -43,6 +51,12 @@ GENDERS = {
     FEMALE: "female",
 }
 GENDER_LIST = [UNKNOWN, MALE, FEMALE]
+# Max number of method requests in batch
+BATCH_MAX_SIZE = 1000
+# Seconds idle persistent connection is kept open, it holds a worker meanwhile
+KEEPALIVE_TIMEOUT = 5
+# Max size of request body accepted by asyncio server
+MAX_BODY_SIZE = 8*1024*1024
 
 def add_years(dt, years):
     try:
@@ -194,6 +208,25 @@ class ClientIDsField(BaseField):
                 raise ValidationError(f'{field_name}: ID must be int')
 
 
+class RequestsField(BaseField):
+    """
+    Method requests of batch
+    """
+    def check_validity(self, field_name, value):
+        """
+        Check validity condition - list of dicts, not empty and not longer than BATCH_MAX_SIZE
+        """
+        if not isinstance(value, list):
+            raise ValidationError(f'{field_name}: value must be a list')
+        if not value:
+            raise ValidationError(f'{field_name}: list can not be empty')
+        if len(value) > BATCH_MAX_SIZE:
+            raise ValidationError(f'{field_name}: no more than {BATCH_MAX_SIZE} requests allowed')
+        for item in value:
+            if not isinstance(item, dict):
+                raise ValidationError(f'{field_name}: request must be dict')
+
+
 class BaseMethod():
     """
     Parent class for parsing and validating json requests
@@ -208,18 +241,28 @@ class BaseMethod():
         self.parameters = {}
         self.wrong_fields = []
 
+        fields = self.get_fields()
         for field, value in request.items():
-            if field not in self.__class__.__dict__:
+            if field not in fields:
                 continue
             setattr(self, field, value) # Seting field value to object instance
             self.parameters[field] = value
 
+    @classmethod
+    def get_fields(cls):
+        """
+        Fields (instances of BaseField) of class and its parent classes
+        in order of declaration, parent fields first
+        """
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            fields.update((name, value) for name, value in vars(klass).items()
+                          if isinstance(value, BaseField))
+        return fields
 
     def check_request_validity(self):
-        # iterate over class fields (instance of BaseField)
-        for field_name, field in self.__class__.__dict__.items():
-            if not isinstance(field, BaseField):
-                continue
+        # iterate over class fields including inherited ones
+        for field_name, field in self.get_fields().items():
             # check if param in request
             # get field of object (which has the same name as class field)
             field_value = getattr(self, field_name)
@@ -296,15 +339,13 @@ class OnlineScoreRequest(BaseMethod):
         return ''
 
 
-class MethodRequest(BaseMethod):
+class AuthRequest(BaseMethod):
     """
-    Parse and check validity of request
+    Auth fields shared by method request and batch
     """
     account = CharField(required=False, nullable=True)
     login = CharField(required=True, nullable=True)
     token = CharField(required=True, nullable=True)
-    arguments = ArgumentsField(required=True, nullable=True)
-    method = CharField(required=True, nullable=False)
 
     @property
     def is_admin(self):
@@ -314,6 +355,22 @@ class MethodRequest(BaseMethod):
         return self.login == ADMIN_LOGIN
 
 
+class MethodRequest(AuthRequest):
+    """
+    Parse and check validity of request
+    """
+    arguments = ArgumentsField(required=True, nullable=True)
+    method = CharField(required=True, nullable=False)
+
+
+class BatchRequest(AuthRequest):
+    """
+    Batch of method requests under one auth,
+    requests are dicts with method and arguments
+    """
+    requests = RequestsField(required=True)
+
+
 def check_auth(request):
     """
     Check auth token is valid
@@ -329,51 +386,72 @@ def check_auth(request):
     return False
 
 
+def validate_arguments(request_class, method_request):
+    """
+    Parse method arguments with request_class.
+    Return arguments request and error response or None
+    """
+    arguments_request = request_class(method_request.arguments)
+    if not arguments_request.check_request_validity():
+        return arguments_request, (arguments_request.get_request_errors(), INVALID_REQUEST)
+    return arguments_request, None
+
+
 def online_score_handler(method_request, ctx, store):
     """
     Process onlinescore request and return response
     """
-    online_score_request = OnlineScoreRequest(method_request.arguments)
-    if not online_score_request.check_request_validity():
-        error_message = online_score_request.get_request_errors()
-        return error_message, INVALID_REQUEST
+    online_score_request, error = validate_arguments(OnlineScoreRequest, method_request)
+    if error:
+        return error
     ctx['has'] = [key for key in online_score_request.parameters]
     if method_request.is_admin:
         return {'score': 42}, OK
     return {'score': get_score(store, **online_score_request.parameters)}, OK
 
 
-def clients_interests_handler(method_request, ctx, store):
+def interests_response(client_ids, interests):
     """
-    Process clientsinterests request and return response
+    Make clientsinterests response from dict of interests found for client ids
     """
-    clients_interests_request = ClientsInterestsRequest(method_request.arguments)
-    if not clients_interests_request.check_request_validity():
-        error_message = clients_interests_request.get_request_errors()
-        return error_message, INVALID_REQUEST
-    ctx['nclients'] = len(clients_interests_request.client_ids)
-    response = {}
-    for id in clients_interests_request.client_ids:
-        interests = get_interests(store, id)
-        if interests:
-            response[str(id)] = interests
+    response = {str(cid): interests[cid] for cid in client_ids if interests[cid]}
     if response:
         return response, OK
-    else:
-        return 'Not Found any of client ids', NOT_FOUND
+    return 'Not Found any of client ids', NOT_FOUND
 
 
-def method_handler(request, ctx, store):
+def clients_interests_handler(method_request, ctx, store):
     """
-    Common request processing and routing to specific handler
+    Process clientsinterests request and return response
+    """
+    clients_interests_request, error = validate_arguments(ClientsInterestsRequest, method_request)
+    if error:
+        return error
+    client_ids = clients_interests_request.client_ids
+    ctx['nclients'] = len(client_ids)
+    return interests_response(client_ids, get_interests_many(store, client_ids))
+
+
+def check_method_request(request):
+    """
+    Parse method request and check its auth.
+    Return method request and error response or None
     """
     method_request = MethodRequest(request['body'])
     if not method_request.check_request_validity():
-        error_message = method_request.get_request_errors()
-        return error_message, INVALID_REQUEST
-
+        return method_request, (method_request.get_request_errors(), INVALID_REQUEST)
     if not check_auth(method_request):
-        return '', FORBIDDEN
+        return method_request, ('', FORBIDDEN)
+    return method_request, None
+
+
+def method_handler(request, ctx, store):
+    """
+    Common request processing and routing to specific handler
+    """
+    method_request, error = check_method_request(request)
+    if error:
+        return error
 
     method_router = {
         "online_score": online_score_handler,
@@ -384,13 +462,156 @@ def method_handler(request, ctx, store):
     return '', NOT_FOUND
 
 
+def validate_batch(request):
+    """
+    Parse batch, check its auth once and validate each method request.
+    Return list of (method_request, clients_interests_request, error response or None)
+    and error response of batch or None
+    """
+    batch_request = BatchRequest(request['body'])
+    if not batch_request.check_request_validity():
+        return [], (batch_request.get_request_errors(), INVALID_REQUEST)
+    if not check_auth(batch_request):
+        return [], ('', FORBIDDEN)
+    auth = {field: batch_request.parameters[field] for field in AuthRequest.get_fields()
+            if field in batch_request.parameters}
+    items = []
+    for item in batch_request.requests:
+        method_request = MethodRequest(dict(item, **auth))
+        clients_interests_request, error = None, None
+        if not method_request.check_request_validity():
+            error = method_request.get_request_errors(), INVALID_REQUEST
+        elif method_request.method == "clients_interests":
+            clients_interests_request, error = validate_arguments(ClientsInterestsRequest,
+                                                                  method_request)
+        elif method_request.method != "online_score":
+            error = '', NOT_FOUND
+        items.append((method_request, clients_interests_request, error))
+    return items, None
+
+
+def batch_client_ids(items):
+    """
+    Client ids of all valid clientsinterests requests of batch
+    """
+    return [cid for _, request, error in items if request and not error
+            for cid in request.client_ids]
+
+
+def batch_response(items, ctx, store, interests):
+    """
+    Make list of responses of batch items, interests of clients are fetched already
+    """
+    ctx['nrequests'] = len(items)
+    results = []
+    for method_request, clients_interests_request, error in items:
+        if error:
+            response, code = error
+        elif clients_interests_request:
+            response, code = interests_response(clients_interests_request.client_ids, interests)
+        else:
+            response, code = online_score_handler(method_request, {}, store)
+        results.append(make_response(response, code))
+    return results
+
+
+def batch_handler(request, ctx, store):
+    """
+    Process batch of method requests and return list of their responses
+    """
+    items, error = validate_batch(request)
+    if error:
+        return error
+    interests = get_interests_many(store, batch_client_ids(items))
+    return batch_response(items, ctx, store, interests), OK
+
+
+async def online_score_handler_async(method_request, ctx, store):
+    """
+    Process onlinescore request on event loop.
+    Score cache is local, so nothing is awaited
+    """
+    return online_score_handler(method_request, ctx, store)
+
+
+async def clients_interests_handler_async(method_request, ctx, store):
+    """
+    Process clientsinterests request on event loop, interests of all
+    client ids are requested from store concurrently
+    """
+    clients_interests_request, error = validate_arguments(ClientsInterestsRequest, method_request)
+    if error:
+        return error
+    client_ids = clients_interests_request.client_ids
+    ctx['nclients'] = len(client_ids)
+    return interests_response(client_ids, await get_interests_many_async(store, client_ids))
+
+
+async def method_handler_async(request, ctx, store):
+    """
+    Common request processing and routing to specific async handler
+    """
+    method_request, error = check_method_request(request)
+    if error:
+        return error
+
+    method_router = {
+        "online_score": online_score_handler_async,
+        "clients_interests": clients_interests_handler_async
+    }
+    if method_request.method in method_router:
+        return await method_router[method_request.method](method_request, ctx, store)
+    return '', NOT_FOUND
+
+
+async def batch_handler_async(request, ctx, store):
+    """
+    Process batch of method requests on event loop and return list of their responses
+    """
+    items, error = validate_batch(request)
+    if error:
+        return error
+    interests = await get_interests_many_async(store, batch_client_ids(items))
+    return batch_response(items, ctx, store, interests), OK
+
+
+def get_request_id(headers):
+    """
+    Get or create random request id
+    """
+    return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+
+
+def make_response(response, code):
+    """
+    Make response dict with code or error
+    """
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def make_response_body(response, code, context):
+    """
+    Make json body of response, log it with request context
+    """
+    r = make_response(response, code)
+    context.update(r)
+    logging.info(context)
+    return json.dumps(r).encode('utf-8')
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     """
-    HTTP request handler
+    HTTP request handler, connections are persistent (HTTP/1.1)
+    unless client closes them or is idle for KEEPALIVE_TIMEOUT seconds
     """
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
     router = {
         "online_score": method_handler,
-        "clients_interests": method_handler
+        "clients_interests": method_handler,
+        "batch": batch_handler
     }
     store = TarantoolStore()
 
@@ -398,7 +619,7 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         """
         Get or create random request id
         """
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return get_request_id(headers)
 
     def do_POST(self):
         """
@@ -408,11 +629,22 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string.decode('utf-8'))
-        except Exception as e:
+            content_length = int(self.headers['Content-Length'])
+            if content_length < 0:
+                raise ValueError('Negative Content-Length')
+        except (TypeError, ValueError) as e:
             logging.exception("Bad request error: %s" % e)
+            # body can't be separated from the next request
+            self.close_connection = True
+            content_length = None
             code = BAD_REQUEST
+        if content_length is not None:
+            try:
+                data_string = self.rfile.read(content_length)
+                request = json.loads(data_string.decode('utf-8'))
+            except Exception as e:
+                logging.exception("Bad request error: %s" % e)
+                code = BAD_REQUEST
 
         if request:
             path = self.path.strip("/")
@@ -429,31 +661,227 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             else:
                 code = NOT_FOUND
 
+        body = make_response_body(response, code, context)
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode('utf-8'))
+        self.wfile.write(body)
         return
 
 
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTP server handling connections in bounded pool of worker threads.
+    New connections are not accepted while all workers are busy,
+    they wait in listen queue of the same size as AsyncHTTPServer backlog
+    """
+    request_queue_size = 1024
+    # seconds between checks for shutdown while waiting for free worker
+    slot_poll_interval = 0.5
+
+    def __init__(self, server_address, handler_class, workers):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker')
+        self.slots = threading.BoundedSemaphore(workers)
+        self.stopping = threading.Event()
+
+    def process_request(self, request, client_address):
+        """
+        Handle connection in worker thread, connection is closed
+        if server is shut down while waiting for free worker
+        """
+        while not self.slots.acquire(timeout=self.slot_poll_interval):
+            if self.stopping.is_set():
+                self.shutdown_request(request)
+                return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """
+        Worker function: handle all requests of connection and close it
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def shutdown(self):
+        """
+        Stop serve_forever loop, also when it waits for free worker
+        """
+        self.stopping.set()
+        super().shutdown()
+
+    def server_close(self):
+        """
+        Close listening socket and wait for workers
+        """
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class AsyncHTTPServer():
+    """
+    HTTP server on asyncio streams, all connections are served by one event loop
+    and wait for store without holding a thread. Connections are persistent as
+    with MainHTTPHandler, store must be async (AsyncTarantoolStore)
+    """
+    router = {
+        "online_score": method_handler_async,
+        "clients_interests": method_handler_async,
+        "batch": batch_handler_async
+    }
+    backlog = 1024
+
+    def __init__(self, server_address, store):
+        self.server_address = server_address
+        self.store = store
+        self.server = None
+
+    async def start(self):
+        """
+        Connect store and start listening, port 0 is replaced with bound one
+        """
+        await self.store.connect()
+        self.server = await asyncio.start_server(self.handle_connection, *self.server_address,
+                                                 backlog=self.backlog)
+        self.server_address = self.server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        """
+        Start server and serve until cancelled
+        """
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            await self.store.close()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handle all requests of connection and close it
+        """
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def handle_request(self, reader, writer):
+        """
+        Read request from connection, process it and write response.
+        Return False if connection should be closed
+        """
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return False
+        request_line, _, header_lines = head.partition(b'\r\n')
+        headers = parse_headers(io.BytesIO(header_lines))
+        context = {"request_id": get_request_id(headers)}
+        response, code = {}, BAD_REQUEST
+        keep_alive = False
+        parts = request_line.decode('latin-1').split()
+        if len(parts) == 3 and parts[0] == 'POST':
+            path, version = parts[1:]
+            connection = headers.get('Connection', '').lower()
+            keep_alive = (connection == 'keep-alive'
+                          or version == 'HTTP/1.1' and connection != 'close')
+            try:
+                content_length = int(headers['Content-Length'])
+                if content_length < 0:
+                    raise ValueError('Negative Content-Length')
+            except (TypeError, ValueError) as e:
+                logging.exception("Bad request error: %s" % e)
+                # body can't be separated from the next request
+                keep_alive = False
+            else:
+                if content_length > MAX_BODY_SIZE:
+                    # body is not read, so the connection can't be reused
+                    code = REQUEST_TOO_LARGE
+                    keep_alive = False
+                else:
+                    try:
+                        data_string = await asyncio.wait_for(reader.readexactly(content_length),
+                                                             KEEPALIVE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        return False
+                    response, code = await self.process_request(path, data_string, headers,
+                                                                context)
+
+        body = make_response_body(response, code, context)
+        writer.write(("HTTP/1.1 %d %s\r\n"
+                      "Content-Type: application/json\r\n"
+                      "Content-Length: %d\r\n"
+                      "Connection: %s\r\n\r\n" % (code, HTTPStatus(code).phrase, len(body),
+                                                    'keep-alive' if keep_alive else 'close'))
+                     .encode('latin-1') + body)
+        await writer.drain()
+        return keep_alive
+
+    async def process_request(self, path, data_string, headers, context):
+        """
+        Process POST request body as MainHTTPHandler.do_POST does,
+        return response and code
+        """
+        try:
+            request = json.loads(data_string.decode('utf-8'))
+        except Exception as e:
+            logging.exception("Bad request error: %s" % e)
+            return {}, BAD_REQUEST
+        if not request:
+            return {}, OK
+        logging.info("%s: %s %s" % (path, data_string, context["request_id"]))
+        path = path.strip("/")
+        if path not in self.router:
+            return {}, NOT_FOUND
+        try:
+            return await self.router[path]({"body": request, "headers": headers},
+                                           context,
+                                           self.store)
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            return {}, INTERNAL_ERROR
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=8)
+    op.add_option("-e", "--engine", action="store", type="choice",
+                  choices=["threads", "asyncio"], default="threads")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.NOTSET,
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    if opts.engine == "asyncio":
+        server = AsyncHTTPServer(("localhost", opts.port), AsyncTarantoolStore())
+        logging.info("Starting asyncio server at %s" % opts.port)
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
+    else:
+        server = ThreadPoolHTTPServer(("localhost", opts.port), MainHTTPHandler, opts.workers)
+        logging.info("Starting server at %s with %s workers" % (opts.port, opts.workers))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
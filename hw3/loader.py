@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bulk loader of client interests into store
+run:
+python loader.py -f interests.csv -b 1000 -i 8
+"""
+
+import csv
+import json
+import time
+import asyncio
+import logging
+from optparse import OptionParser
+
+from store import AsyncTarantoolStore
+
+# Seconds between progress messages
+REPORT_INTERVAL = 5
+
+
+def read_csv(path, separator):
+    """
+    Read (cid, interests) rows from csv file with client_id and interests columns,
+    interests are joined with separator
+    """
+    with open(path, newline='', encoding='utf-8') as fin:
+        for row in csv.DictReader(fin):
+            interests = row['interests'].split(separator) if row['interests'] else []
+            yield int(row['client_id']), interests
+
+
+def read_jsonl(path):
+    """
+    Read (cid, interests) rows from file of json objects with client_id and interests
+    """
+    with open(path, encoding='utf-8') as fin:
+        for line in fin:
+            if line.strip():
+                row = json.loads(line)
+                yield int(row['client_id']), list(row['interests'])
+
+
+def read_rows(path, file_format=None, separator=';'):
+    """
+    Read rows of csv or jsonl file, format is taken from extension if not given
+    """
+    if file_format is None:
+        file_format = 'csv' if path.endswith('.csv') else 'jsonl'
+    if file_format == 'csv':
+        return read_csv(path, separator)
+    return read_jsonl(path)
+
+
+def iter_batches(rows, batch_size):
+    """
+    Split rows into lists of batch_size rows
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def load(store, rows, batch_size=1000, max_in_flight=8):
+    """
+    Write rows to store with set_many in batches, no more than max_in_flight
+    batches are written at once. Return number of rows loaded
+    """
+    loaded = 0
+    pending = set()
+    start_time = report_time = time.perf_counter()
+    for batch in iter_batches(rows, batch_size):
+        if len(pending) >= max_in_flight:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            loaded += sum(task.result() for task in done)
+            if time.perf_counter() - report_time > REPORT_INTERVAL:
+                report_time = time.perf_counter()
+                logging.info("Loaded %s rows, %.0f rows/sec"
+                             % (loaded, loaded/(report_time - start_time)))
+        pending.add(asyncio.ensure_future(store.set_many(batch)))
+    if pending:
+        loaded += sum(await asyncio.gather(*pending))
+    return loaded
+
+
+async def main(opts):
+    """
+    Main function
+    """
+    store = AsyncTarantoolStore()
+    await store.connect()
+    start_time = time.perf_counter()
+    try:
+        loaded = await load(store, read_rows(opts.file, opts.format, opts.separator),
+                            opts.batch_size, opts.in_flight)
+    finally:
+        await store.close()
+    elapsed = time.perf_counter() - start_time
+    logging.info("Loaded %s rows in %.1f s, %.0f rows/sec"
+                 % (loaded, elapsed, loaded/elapsed if elapsed else 0))
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-f", "--file", action="store", help="csv or jsonl file of client interests")
+    op.add_option("--format", action="store", type="choice", choices=["csv", "jsonl"],
+                  default=None)
+    op.add_option("-s", "--separator", action="store", default=";")
+    op.add_option("-b", "--batch-size", action="store", type=int, default=1000)
+    op.add_option("-i", "--in-flight", action="store", type=int, default=8)
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    if not opts.file:
+        op.error("file is required")
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    asyncio.run(main(opts))
@@ -33,3 +33,12 @@ def get_score(store,  phone=None, email=None, birthday=None, gender=None, first_
 
 def get_interests(store, cid):
     return store.get(cid)
+
+
+def get_interests_many(store, cids):
+    # every distinct id is fetched once, all in one store round trip
+    return store.get_many(dict.fromkeys(cids))
+
+
+async def get_interests_many_async(store, cids):
+    return await store.get_many(dict.fromkeys(cids))
@@ -1,5 +1,11 @@
 import tarantool
 import time
+import threading
+
+try:
+    import asynctnt
+except ImportError:
+    asynctnt = None
 
 CONFIG = {
     'host': '127.0.0.1',
@@ -11,9 +17,64 @@ CONFIG = {
     'space': 'tester'
 }
 
-class TarantoolStore():
+# Select many keys of space in one request, return list of {key, value} found
+GET_MANY_LUA = """
+local space, keys = ...
+local result = {}
+for _, key in ipairs(keys) do
+    local tuple = box.space[space]:get(key)
+    if tuple ~= nil then
+        table.insert(result, {key, tuple[2]})
+    end
+end
+return result
+"""
+
+# Replace many tuples of space in one request and transaction, return their number
+SET_MANY_LUA = """
+local space, tuples = ...
+box.begin()
+for _, tuple in ipairs(tuples) do
+    box.space[space]:replace(tuple)
+end
+box.commit()
+return #tuples
+"""
+
+class LocalCache():
+    """
+    Local score cache of store, available without connection
+    """
+
+    def cache_get(self, key):
+        item = self.local_cache.get(key)
+        if item is None:
+            return 0
+        value, expire_time = item
+        if expire_time < time.time():
+            self.local_cache.pop(key, None)
+            return 0
+        return value
+
+    def cache_set(self, key, score, storage_time):
+        """
+        :param key: any value that can be an identifier for score
+        :param score: score value to store
+        :param storage_time: (seconds) how long the value will be available in cache
+        :return:
+        """
+        self.local_cache[key] = (score, time.time() + storage_time)
+
+
+class TarantoolStore(LocalCache):
+    """
+    Store of client interests in Tarantool and local score cache.
+    Each server worker thread opens its own Tarantool connection,
+    so slow calls of one worker don't block the others
+    """
 
     def __init__(self, config=None, connect_now=True):
+        self.local = threading.local()
         if connect_now:
             self.connect(config=config)
 
@@ -21,42 +82,122 @@ class TarantoolStore():
         self.local_cache = {}
         if config is None:
             config = CONFIG
+        self.config = config
         self.space_name = config['space']
-        if config['simple_mode']:
-            self.tnt = tarantool.connect(config['host'], config['port'])
-        else:
-            self.tnt = tarantool.Connection(config['host'], config['port'],
-                      socket_timeout=config['socket_timeout'],
-                      reconnect_max_attempts=config['reconnect_max_attempts'],
-                      reconnect_delay=config['reconnect_delay'])
-
         self.tnt.eval(f"box.schema.space.create('{self.space_name}', {{if_not_exists=true}})")
         self.tnt.eval("box.space.tester:create_index('primary', {if_not_exists=true})")
 
+    @property
+    def tnt(self):
+        """
+        Connection of current thread, opened on first use
+        """
+        connection = getattr(self.local, 'tnt', None)
+        if connection is None:
+            config = self.config
+            if config['simple_mode']:
+                connection = tarantool.connect(config['host'], config['port'])
+            else:
+                connection = tarantool.Connection(config['host'], config['port'],
+                             socket_timeout=config['socket_timeout'],
+                             reconnect_max_attempts=config['reconnect_max_attempts'],
+                             reconnect_delay=config['reconnect_delay'])
+            self.local.tnt = connection
+        return connection
+
     def get(self, cid):
         res = self.tnt.select(self.space_name, cid)
         if res.data:
             return res.data[0][1]['interests']
         return None
 
+    def get_many(self, cids):
+        """
+        Get interests of many clients in one round trip.
+        Return dict of interests by client id, None for not found ids
+        """
+        cids = list(cids)
+        result = dict.fromkeys(cids)
+        if not cids:
+            return result
+        res = self.tnt.eval(GET_MANY_LUA, self.space_name, cids)
+        for cid, value in res.data[0] or []:
+            result[cid] = value['interests']
+        return result
+
     def set(self, cid, interests):
-        self.tnt.delete(self.space_name, cid)
-        self.tnt.insert(self.space_name, (cid, {'interests': interests}))
+        self.tnt.replace(self.space_name, (cid, {'interests': interests}))
 
-    def cache_get(self, key):
-        if key not in self.local_cache:
-            return 0
-        value, expire_time = self.local_cache[key]
-        if expire_time < time.time():
-            del self.local_cache[key]
+    def set_many(self, items):
+        """
+        Set interests of many clients from (cid, interests) pairs in one round trip.
+        Return number of clients set
+        """
+        tuples = [(cid, {'interests': interests}) for cid, interests in items]
+        if not tuples:
             return 0
-        return value
+        self.tnt.eval(SET_MANY_LUA, self.space_name, tuples)
+        return len(tuples)
 
-    def cache_set(self, key, score, storage_time):
+
+class AsyncTarantoolStore(LocalCache):
+    """
+    Store of client interests in Tarantool for asyncio server.
+    Requests of concurrent coroutines are pipelined over one asynctnt connection
+    """
+
+    def __init__(self, config=None):
+        self.local_cache = {}
+        self.config = config or CONFIG
+        self.space_name = self.config['space']
+        self.tnt = None
+
+    async def connect(self):
+        if asynctnt is None:
+            raise RuntimeError('asynctnt package is required for async store')
+        self.tnt = asynctnt.Connection(host=self.config['host'], port=self.config['port'],
+                                       connect_timeout=self.config['socket_timeout'],
+                                       request_timeout=self.config['socket_timeout'],
+                                       reconnect_timeout=self.config['reconnect_delay'])
+        await self.tnt.connect()
+        await self.tnt.eval(f"box.schema.space.create('{self.space_name}', {{if_not_exists=true}})")
+        await self.tnt.eval(f"box.space.{self.space_name}:create_index('primary', "
+                            f"{{if_not_exists=true}})")
+
+    async def get(self, cid):
+        res = await self.tnt.select(self.space_name, [cid])
+        if len(res):
+            return res[0][1]['interests']
+        return None
+
+    async def get_many(self, cids):
         """
-        :param key: any value that can be an identifier for score
-        :param score: score value to store
-        :param storage_time: (seconds) how long the value will be available in cache
-        :return:
+        Get interests of many clients in one round trip.
+        Return dict of interests by client id, None for not found ids
         """
-        self.local_cache[key] = (score, time.time() + storage_time)
+        cids = list(cids)
+        result = dict.fromkeys(cids)
+        if not cids:
+            return result
+        res = await self.tnt.eval(GET_MANY_LUA, [self.space_name, cids])
+        for cid, value in res[0] or []:
+            result[cid] = value['interests']
+        return result
+
+    async def set(self, cid, interests):
+        await self.tnt.replace(self.space_name, [cid, {'interests': interests}])
+
+    async def set_many(self, items):
+        """
+        Set interests of many clients from (cid, interests) pairs in one round trip.
+        Return number of clients set
+        """
+        tuples = [[cid, {'interests': interests}] for cid, interests in items]
+        if not tuples:
+            return 0
+        await self.tnt.eval(SET_MANY_LUA, [self.space_name, tuples])
+        return len(tuples)
+
+    async def close(self):
+        if self.tnt is not None:
+            await self.tnt.disconnect()
@@ -59,6 +59,27 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(api.NOT_FOUND, code, arguments)
 
 
+    @cases([
+        ([1, 2, 3], [3005001, 3005002]),
+        ([], [3005001]),
+    ])
+    def test_store_get_many(self, ids, missing_ids):
+        self.add_fake_data(self.store, ids)
+        result = self.store.get_many(ids + missing_ids)
+        self.assertEqual(sorted(ids + missing_ids), sorted(result))
+        for id in ids:
+            self.assertEqual(self.store.get(id), result[id])
+        for id in missing_ids:
+            self.assertIsNone(result[id])
+
+    @cases([
+        [(1, ["cars", "pets"]), (2, []), (3005003, ["books"])],
+    ])
+    def test_store_set_many(self, items):
+        self.assertEqual(len(items), self.store.set_many(items))
+        self.assertEqual(dict(items), self.store.get_many([cid for cid, _ in items]))
+        self.assertEqual(0, self.store.set_many([]))
+
     @cases([
         {"birthday": "01.01.2000", "first_name": "a", "last_name": "b", 'phone':79261111111}
     ])
@@ -2,9 +2,18 @@ import hashlib
 import datetime
 import unittest
 import random
+import json
+import threading
+import io
+import http.client
+import asyncio
+import time
+import os
+import tempfile
 
 import api
-from tests.utils import cases
+import loader
+from tests.utils import cases, FakeAsyncStore
 
 
 class TestSuite(unittest.TestCase):
@@ -241,6 +250,279 @@ class TestSuite(unittest.TestCase):
         response, code = self.get_response(request)
         self.assertEqual(expected_code, code)
 
+    @cases([
+        ([{"method": "online_score", "arguments": {"phone": "79175002040", "email": "a@b.ru"}},
+          {"method": "online_score", "arguments": {"phone": "79175002040"}},
+          {"method": "unknown", "arguments": {}},
+          {"arguments": {}}],
+         [api.OK, api.INVALID_REQUEST, api.NOT_FOUND, api.INVALID_REQUEST]),
+    ])
+    def test_batch_request(self, requests, codes):
+        request = {"account": "horns&hoofs", "login": "h&f", "requests": requests}
+        self.set_valid_auth(request)
+        response, code = api.batch_handler({"body": request, "headers": self.headers},
+                                           self.context, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(codes, [item["code"] for item in response])
+        self.assertEqual(3.0, response[0]["response"]["score"])
+        self.assertTrue(response[1]["error"])
+        self.assertEqual(self.context["nrequests"], len(requests))
+
+    @cases([
+        ({"account": "horns&hoofs", "login": "h&f", "token": "",
+          "requests": [{"method": "online_score", "arguments": {}}]}, api.FORBIDDEN),
+        ({"account": "horns&hoofs", "login": "h&f", "requests": []}, api.INVALID_REQUEST),
+        ({"account": "horns&hoofs", "login": "h&f", "requests": [1]}, api.INVALID_REQUEST),
+        ({"account": "horns&hoofs", "login": "h&f",
+          "requests": [{}] * (api.BATCH_MAX_SIZE + 1)}, api.INVALID_REQUEST),
+    ])
+    def test_bad_batch_request(self, request, expected_code):
+        if "token" not in request:
+            self.set_valid_auth(request)
+        _, code = api.batch_handler({"body": request, "headers": self.headers},
+                                    self.context, self.store)
+        self.assertEqual(expected_code, code)
+
+    def test_auth_fields_inherited(self):
+        self.assertEqual(list(api.MethodRequest.get_fields()),
+                         ["account", "login", "token", "arguments", "method"])
+        self.assertEqual(list(api.BatchRequest.get_fields()),
+                         ["account", "login", "token", "requests"])
+        batch_request = api.BatchRequest({"login": "h&f", "requests": [{}]})
+        self.assertFalse(batch_request.check_request_validity())
+        self.assertEqual(batch_request.missed_required, ["token"])
+
+    def test_keepalive_server(self):
+        server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, 2)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        self.set_valid_auth(request)
+        try:
+            connection = http.client.HTTPConnection("localhost", server.server_address[1])
+            sockets = []
+            for body in (json.dumps(request), "{not json"):
+                connection.request("POST", "/online_score", body)
+                response = connection.getresponse()
+                data = response.read()
+                self.assertEqual(int(response.getheader("Content-Length")), len(data))
+                sockets.append(connection.sock)
+            # the same connection is used for both requests
+            self.assertIs(sockets[0], sockets[1])
+            self.assertEqual(json.loads(data)["code"], api.BAD_REQUEST)
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_keepalive_server_bad_length(self):
+        server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, 2)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            connection = http.client.HTTPConnection("localhost", server.server_address[1])
+            connection.putrequest("POST", "/online_score")
+            connection.putheader("Content-Length", "abc")
+            connection.endheaders()
+            response = connection.getresponse()
+            self.assertEqual(api.BAD_REQUEST, json.loads(response.read())["code"])
+            self.assertEqual("close", response.getheader("Connection"))
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_server_shutdown_with_busy_workers(self):
+        server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, 1)
+        self.assertEqual(server.request_queue_size, 1024)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        # the only worker keeps idle persistent connection, the next one waits for it
+        busy = http.client.HTTPConnection("localhost", server.server_address[1])
+        busy.request("POST", "/online_score", "{not json")
+        busy.getresponse().read()
+        waiting = http.client.HTTPConnection("localhost", server.server_address[1])
+        waiting.connect()
+        time.sleep(0.2)
+        stopper = threading.Thread(target=server.shutdown, daemon=True)
+        stopper.start()
+        stopper.join(timeout=3)
+        self.assertFalse(stopper.is_alive())
+        waiting.close()
+        busy.close()
+        server.server_close()
+
+    def test_store_connection_per_thread(self):
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(self.store.tnt))
+        thread.start()
+        thread.join()
+        self.assertIsNot(self.store.tnt, connections[0])
+        self.assertIs(self.store.tnt, self.store.tnt)
+
+
+class AsyncTestSuite(unittest.TestCase):
+
+    def setUp(self):
+        self.context = {}
+        self.headers = {}
+        self.store = FakeAsyncStore({1: ["books", "hi-tech"], 2: ["sport"]}, delay=0.05)
+
+    def get_response(self, request):
+        return asyncio.run(api.method_handler_async({"body": request, "headers": self.headers},
+                                                    self.context, self.store))
+
+    def make_request(self, method, arguments, login="h&f"):
+        request = {"account": "horns&hoofs", "login": login, "method": method,
+                   "arguments": arguments}
+        TestSuite.set_valid_auth(self, request)
+        return request
+
+    @cases([
+        ({"client_ids": [1, 2]}, {"1": ["books", "hi-tech"], "2": ["sport"]}),
+        ({"client_ids": [2, 3], "date": "19.07.2017"}, {"2": ["sport"]}),
+    ])
+    def test_ok_async_interests_request(self, arguments, expected):
+        response, code = self.get_response(self.make_request("clients_interests", arguments))
+        self.assertEqual(api.OK, code)
+        self.assertEqual(expected, response)
+        self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
+
+    @cases([
+        ("clients_interests", {"client_ids": [3]}, api.NOT_FOUND),
+        ("clients_interests", {"client_ids": []}, api.INVALID_REQUEST),
+        ("online_score", {"phone": "79175002040"}, api.INVALID_REQUEST),
+        ("unknown", {}, api.NOT_FOUND),
+    ])
+    def test_bad_async_request(self, method, arguments, expected):
+        _, code = self.get_response(self.make_request(method, arguments))
+        self.assertEqual(expected, code)
+
+    def test_ok_async_score_request(self):
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        response, code = self.get_response(self.make_request("online_score", arguments))
+        self.assertEqual(api.OK, code)
+        self.assertEqual(3.0, response["score"])
+        self.assertEqual(sorted(self.context["has"]), sorted(arguments))
+
+    def test_async_batch_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "requests": [
+            {"method": "clients_interests", "arguments": {"client_ids": [1, 2]}},
+            {"method": "online_score", "arguments": {"first_name": "a", "last_name": "b"}},
+            {"method": "clients_interests", "arguments": {"client_ids": [2, 3]}},
+            {"method": "clients_interests", "arguments": {"client_ids": [3]}},
+            {"method": "clients_interests", "arguments": {"client_ids": [4], "date": "1"}},
+        ]}
+        TestSuite.set_valid_auth(self, request)
+        response, code = asyncio.run(api.batch_handler_async(
+            {"body": request, "headers": self.headers}, self.context, self.store))
+        self.assertEqual(api.OK, code)
+        self.assertEqual([api.OK, api.OK, api.OK, api.NOT_FOUND, api.INVALID_REQUEST],
+                         [item["code"] for item in response])
+        self.assertEqual({"1": ["books", "hi-tech"], "2": ["sport"]}, response[0]["response"])
+        self.assertEqual({"score": 0.5}, response[1]["response"])
+        self.assertEqual({"2": ["sport"]}, response[2]["response"])
+        # each client id of valid requests is fetched once
+        self.assertEqual([1, 2, 3], sorted(self.store.requested))
+
+    @cases([
+        ("csv", "client_id,interests\n1,cars;pets\n2,\n3,books\n"),
+        ("jsonl", '{"client_id": 1, "interests": ["cars", "pets"]}\n\n'
+                  '{"client_id": 2, "interests": []}\n{"client_id": 3, "interests": ["books"]}\n'),
+    ])
+    def test_loader(self, file_format, data):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "interests." + file_format)
+            with open(path, "w", encoding="utf-8") as fout:
+                fout.write(data)
+            rows = list(loader.read_rows(path))
+        self.assertEqual([(1, ["cars", "pets"]), (2, []), (3, ["books"])], rows)
+        store = FakeAsyncStore(delay=0.01)
+        loaded = asyncio.run(loader.load(store, rows * 10, batch_size=2, max_in_flight=3))
+        self.assertEqual(30, loaded)
+        self.assertEqual({1: ["cars", "pets"], 2: [], 3: ["books"]}, store.interests)
+        self.assertEqual(3, store.max_in_flight)
+
+    async def post(self, reader, writer, path, body):
+        data = body.encode('utf-8')
+        writer.write(b"POST %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s"
+                     % (path.encode('utf-8'), len(data), data))
+        head = await reader.readuntil(b"\r\n\r\n")
+        headers = http.client.parse_headers(io.BytesIO(head.partition(b"\r\n")[2]))
+        data = await reader.readexactly(int(headers["Content-Length"]))
+        return json.loads(data), headers["Connection"]
+
+    async def run_clients(self, clients):
+        server = api.AsyncHTTPServer(("localhost", 0), self.store)
+        await server.start()
+        request = json.dumps(self.make_request("clients_interests", {"client_ids": [1, 2, 3]}))
+
+        async def client():
+            reader, writer = await asyncio.open_connection(*server.server_address)
+            # two requests over the same connection
+            results = [await self.post(reader, writer, "/clients_interests", request),
+                       await self.post(reader, writer, "/clients_interests", "{not json")]
+            writer.close()
+            return results
+
+        try:
+            return await asyncio.gather(*(client() for _ in range(clients)))
+        finally:
+            server.server.close()
+            await server.server.wait_closed()
+
+    def test_async_server(self):
+        clients = 200
+        start_time = time.perf_counter()
+        results = asyncio.run(self.run_clients(clients))
+        # store waits of all clients overlap
+        self.assertLess(time.perf_counter() - start_time, clients*self.store.delay/4)
+        for (ok, ok_connection), (bad, bad_connection) in results:
+            self.assertEqual(ok["code"], api.OK)
+            self.assertEqual(ok["response"], {"1": ["books", "hi-tech"], "2": ["sport"]})
+            self.assertEqual(ok_connection, "keep-alive")
+            self.assertEqual(bad["code"], api.BAD_REQUEST)
+            self.assertEqual(bad_connection, "keep-alive")
+
+    async def run_bad_clients(self):
+        server = api.AsyncHTTPServer(("localhost", 0), self.store)
+        serving = asyncio.ensure_future(server.serve_forever())
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        try:
+            reader, writer = await asyncio.open_connection(*server.server_address)
+            writer.write(b"POST /online_score HTTP/1.1\r\nContent-Length: %d\r\n\r\n"
+                         % (api.MAX_BODY_SIZE + 1))
+            large = await reader.read()
+            writer.close()
+            reader, writer = await asyncio.open_connection(*server.server_address)
+            # body is never completed
+            writer.write(b"POST /online_score HTTP/1.1\r\nContent-Length: 10\r\n\r\n{")
+            slow = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+        finally:
+            serving.cancel()
+            try:
+                await serving
+            except asyncio.CancelledError:
+                pass
+        return large, slow
+
+    def test_async_server_bad_clients(self):
+        timeout = api.KEEPALIVE_TIMEOUT
+        api.KEEPALIVE_TIMEOUT = 0.1
+        try:
+            large, slow = asyncio.run(self.run_bad_clients())
+        finally:
+            api.KEEPALIVE_TIMEOUT = timeout
+        head, _, body = large.partition(b"\r\n\r\n")
+        self.assertIn(b"Connection: close", head)
+        self.assertEqual(api.REQUEST_TOO_LARGE, json.loads(body)["code"])
+        # slow client is disconnected without response
+        self.assertEqual(b"", slow)
+        self.assertTrue(self.store.closed)
+
 
 if __name__ == "__main__":
     unittest.main()
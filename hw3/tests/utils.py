@@ -1,5 +1,8 @@
+import asyncio
 import functools
 
+from store import LocalCache
+
 def cases(cases):
     def decorator(f):
         @functools.wraps(f)
@@ -16,3 +19,48 @@ def cases(cases):
             print('OK')
         return wrapper
     return decorator
+
+
+class FakeAsyncStore(LocalCache):
+    """
+    In-memory store with interface of AsyncTarantoolStore,
+    get, get_many, set and set_many wait delay seconds as network round trip would
+    """
+
+    def __init__(self, interests=None, delay=0):
+        self.local_cache = {}
+        self.interests = dict(interests or {})
+        self.delay = delay
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.closed = False
+
+    async def connect(self):
+        pass
+
+    async def get(self, cid):
+        self.requested.append(cid)
+        await asyncio.sleep(self.delay)
+        return self.interests.get(cid)
+
+    async def get_many(self, cids):
+        cids = list(cids)
+        self.requested.extend(cids)
+        await asyncio.sleep(self.delay)
+        return {cid: self.interests.get(cid) for cid in cids}
+
+    async def set(self, cid, interests):
+        await asyncio.sleep(self.delay)
+        self.interests[cid] = interests
+
+    async def set_many(self, items):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.interests.update(items)
+        self.in_flight -= 1
+        return len(items)
+
+    async def close(self):
+        self.closed = True